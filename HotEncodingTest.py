@@ -0,0 +1,49 @@
+import torch
+from models.Conditionners import DAGConditioner
+
+
+def dense_forward(conditioner, x):
+    # Reference: the embedding network applied to the hot encoded masked inputs.
+    sparse_forward, fused_forward = conditioner.sparse_forward, conditioner.fused_forward
+    conditioner.sparse_forward, conditioner.fused_forward = False, False
+    try:
+        return conditioner(x)
+    finally:
+        conditioner.sparse_forward, conditioner.fused_forward = sparse_forward, fused_forward
+
+
+def test_sparse_forward(dim=7, b_size=10):
+    torch.manual_seed(0)
+    conditioner = DAGConditioner(dim, [20, 20], 5, hot_encoding=True)
+    x = torch.randn(b_size, dim)
+    with torch.no_grad():
+        conditioner.post_process(.5)
+        assert conditioner.is_sparse()
+        e, e_dense = conditioner(x), dense_forward(conditioner, x)
+    assert e.shape == (b_size, dim, 5 + dim)
+    assert torch.allclose(e, e_dense, atol=1e-5), "The sparse forward differs by %e" % (e - e_dense).abs().max()
+
+
+def test_fused_forward(dim=7, b_size=10):
+    torch.manual_seed(0)
+    conditioner = DAGConditioner(dim, [20, 20], 5, hot_encoding=True)
+    x = torch.randn(b_size, dim)
+    with torch.no_grad():
+        # Stochastic gates, drawn with the same seed on both paths, then deterministic gates.
+        for stoch_gate in [True, False]:
+            conditioner.stoch_gate = stoch_gate
+            torch.manual_seed(1)
+            e = conditioner(x)
+            torch.manual_seed(1)
+            e_dense = dense_forward(conditioner, x)
+            assert torch.allclose(e, e_dense, atol=1e-5), \
+                "Stochastic gates %s: the fused forward differs by %e" % (stoch_gate, (e - e_dense).abs().max())
+        idx = torch.tensor([4, 1, 5])
+        e = conditioner.partial_forward(x, idx)
+        assert torch.allclose(e, e_dense[:, idx], atol=1e-5), \
+            "The partial forward differs by %e" % (e - e_dense[:, idx]).abs().max()
+
+
+test_sparse_forward()
+test_fused_forward()
+print("Hot encoded DAGMLP checks passed.")
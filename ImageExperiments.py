@@ -1,12 +1,13 @@
 import torch
 from timeit import default_timer as timer
 import lib.utils as utils
+from lib.evaluation import evaluate, threshold_sweep
+from lib.checkpoint import CheckpointManager, non_negative_int
+from lib.dataloader import TensorImageLoader, images_to_tensor, load_mnist
 import os
 import matplotlib
 import matplotlib.pyplot as plt
 import networkx as nx
-from torchvision import datasets, transforms
-from lib.transform import AddUniformNoise, ToTensor, HorizontalFlip, Transpose, Resize
 import numpy as np
 import math
 import torch.nn as nn
@@ -15,107 +16,42 @@ from models.NormalizingFlowFactories import buildMNISTNormalizingFlow, buildCIFA
 from models.Normalizers import AffineNormalizer, MonotonicNormalizer
 from models.Conditionners import *
 import torchvision.datasets as dset
-import torchvision.transforms as tforms
 import matplotlib.animation as animation
 import matplotlib
 import torchvision
 
-def add_noise(x):
-    """
-    [0, 1] -> [0, 255] -> add noise -> [0, 1]
-    """
-    noise = x.new().resize_as_(x).uniform_()
-    x = x * 255 + noise
-    x = x / 256
-    return x
-
-
-def compute_bpp(ll, x, alpha=1e-6):
-    d = x.shape[1]
-    bpp = -ll / (d * np.log(2)) - np.log2(1 - 2 * alpha) + 8 \
-          + 1 / d * (torch.log2(torch.sigmoid(x)) + torch.log2(1. - torch.sigmoid(x))).sum(1)
-    return bpp
-
-
 def load_data(dataset="MNIST", batch_size=100, cuda=-1):
+    device = "cuda:%d" % cuda if cuda > -1 else "cpu"
     if dataset == "MNIST":
-        data = datasets.MNIST('./MNIST', train=True, download=True,
-                              transform=transforms.Compose([
-                                  AddUniformNoise(),
-                                  ToTensor()
-                              ]))
-
-        train_data, valid_data = torch.utils.data.random_split(data, [50000, 10000])
-
-        test_data = datasets.MNIST('./MNIST', train=False, download=True,
-                                   transform=transforms.Compose([
-                                       AddUniformNoise(),
-                                       ToTensor()
-                                   ]))
-        kwargs = {'num_workers': 0, 'pin_memory': True} if cuda > -1 else {}
-
-        train_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size, shuffle=True, drop_last=True, **kwargs)
-        valid_loader = torch.utils.data.DataLoader(valid_data, batch_size=batch_size, shuffle=True, drop_last=True, **kwargs)
-        test_loader = torch.utils.data.DataLoader(test_data, batch_size=batch_size, shuffle=True, drop_last=True, **kwargs)
+        train_data, valid_data, test_data = load_mnist(device=device)
+        alpha, hflip = 1e-6, False
     elif len(dataset) == 6 and dataset[:5] == 'MNIST':
-        data = datasets.MNIST('./MNIST', train=True, download=True,
-                              transform=transforms.Compose([
-                                  AddUniformNoise(),
-                                  ToTensor()
-                              ]))
-        label = int(dataset[5])
-        idx = data.train_labels == label
-        data.targets = data.train_labels[idx]
-        data.data = data.train_data[idx]
-
-        train_data, valid_data = torch.utils.data.random_split(data, [5000, idx.sum() - 5000])
-
-        test_data = datasets.MNIST('./MNIST', train=False, download=True,
-                                   transform=transforms.Compose([
-                                       AddUniformNoise(),
-                                       ToTensor()
-                                   ]))
-        idx = test_data.test_labels == label
-        test_data.targets = test_data.test_labels[idx]
-        test_data.data = test_data.test_data[idx]
-
-        kwargs = {'num_workers': 0, 'pin_memory': True} if cuda > -1 else {}
-
-        train_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size, shuffle=True, drop_last=True,
-                                                   **kwargs)
-        valid_loader = torch.utils.data.DataLoader(valid_data, batch_size=batch_size, shuffle=True, drop_last=True,
-                                                   **kwargs)
-        test_loader = torch.utils.data.DataLoader(test_data, batch_size=batch_size, shuffle=True, drop_last=True,
-                                                  **kwargs)
+        train_data, valid_data, test_data = load_mnist(label=int(dataset[5]), nb_train=5000, device=device)
+        alpha, hflip = 1e-6, False
     elif dataset == "CIFAR10":
-        im_dim = 3
-        im_size = 32  # if args.imagesize is None else args.imagesize
-        trans = lambda im_size: tforms.Compose([tforms.Resize(im_size), tforms.ToTensor(), add_noise])
-        train_data = dset.CIFAR10(
-            root="./data", train=True, transform=tforms.Compose([
-                tforms.Resize(im_size),
-                tforms.RandomHorizontalFlip(),
-                tforms.ToTensor(),
-                add_noise,
-            ]), download=True
-        )
-        test_data = dset.CIFAR10(root="./data", train=False, transform=trans(im_size), download=True)
-        kwargs = {'num_workers': 0, 'pin_memory': True} if cuda > -1 else {}
-
-        train_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size, drop_last=True, shuffle=True, **kwargs)
+        # Dequantized to [0, 1] without the logit transform.
+        train_data, test_data = [torch.utils.data.TensorDataset(images_to_tensor(d, 32).to(device),
+                                                                torch.as_tensor(d.targets).to(device))
+                                 for d in [dset.CIFAR10(root="./data", train=train, download=True)
+                                           for train in [True, False]]]
         # WARNING VALID = TEST
-        valid_loader = torch.utils.data.DataLoader(test_data, batch_size=batch_size, drop_last=True, shuffle=True, **kwargs)
-        test_loader = torch.utils.data.DataLoader(test_data, batch_size=batch_size, drop_last=True, shuffle=True, **kwargs)
+        valid_data = test_data
+        alpha, hflip = None, True
+    train_loader = TensorImageLoader(train_data, batch_size, alpha, hflip=hflip, drop_last=True)
+    valid_loader = TensorImageLoader(valid_data, batch_size, alpha, drop_last=True)
+    test_loader = TensorImageLoader(test_data, batch_size, alpha, drop_last=True)
     return train_loader, valid_loader, test_loader
 
 
 cond_types = {"DAG": DAGConditioner, "Coupling": CouplingConditioner, "Autoregressive": AutoregressiveConditioner}
+precisions = {"fp32": None, "bf16": torch.bfloat16}
 
 
 def train(dataset="MNIST", load=True, nb_step_dual=100, nb_steps=20, path="", l1=.1, nb_epoch=10000, b_size=100,
           int_net=[50, 50, 50], all_args=None, file_number=None, train=True, solver="CC", weight_decay=1e-5,
           learning_rate=1e-3, batch_per_optim_step=1, n_gpu=1, norm_type='Affine', nb_flow=[1], hot_encoding=True,
-          prior_A_kernel=None, conditioner="DAG", emb_net=None):
+          prior_A_kernel=None, conditioner="DAG", emb_net=None, keep_last=5, precision="fp32",
+          memory_budget=None):
     logger = utils.get_logger(logpath=os.path.join(path, 'logs'), filepath=os.path.abspath(__file__))
     logger.info(str(all_args))
 
@@ -127,7 +63,7 @@ def train(dataset="MNIST", load=True, nb_step_dual=100, nb_steps=20, path="", l1
     best_valid_loss = np.inf
 
     logger.info("Loading data...")
-    train_loader, valid_loader, test_loader = load_data(dataset, batch_size)
+    train_loader, valid_loader, test_loader = load_data(dataset, batch_size, 0 if torch.cuda.is_available() else -1)
     if len(dataset) == 6 and dataset[:5] == 'MNIST':
         dataset = "MNIST"
     alpha = 1e-6 if dataset == "MNIST" else .05
@@ -165,12 +101,15 @@ def train(dataset="MNIST", load=True, nb_step_dual=100, nb_steps=20, path="", l1
             normalizer_args["cond_size"] = emb_net[-1]
 
         inner_model = buildFCNormalizingFlow(nb_flow[0], conditioner_type, conditioner_args, normalizer_type, normalizer_args)
+    inner_model.set_precision(precisions[precision])
+    inner_model.set_memory_budget(memory_budget * 2**20 if memory_budget is not None else None)
     model = nn.DataParallel(inner_model, device_ids=list(range(n_gpu))).to(master_device)
     logger.info(str(model))
     pytorch_total_params = sum(p.numel() for p in model.parameters())
     logger.info("Number of parameters: %d" % pytorch_total_params)
 
     opt = torch.optim.Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    checkpoints = CheckpointManager(path, keep_last=keep_last)
 
     if load:
         logger.info("Loading model...")
@@ -193,6 +132,7 @@ def train(dataset="MNIST", load=True, nb_step_dual=100, nb_steps=20, path="", l1
     for epoch in range(nb_epoch):
         ll_tot = 0
         start = timer()
+        is_best = False
         if train:
             model.to(master_device)
             # ----------------------- Training Loop ------------------------- #
@@ -211,7 +151,7 @@ def train(dataset="MNIST", load=True, nb_step_dual=100, nb_steps=20, path="", l1
                 if batch_idx % batch_per_optim_step == 0:
                     opt.zero_grad()
 
-                loss.backward(retain_graph=True)
+                loss.backward()
                 if (batch_idx + 1) % batch_per_optim_step == 0:
                     opt.step()
 
@@ -226,21 +166,13 @@ def train(dataset="MNIST", load=True, nb_step_dual=100, nb_steps=20, path="", l1
             ll_tot = 0.
 
         # ----------------------- Valid Loop ------------------------- #
-        ll_test = 0.
-        bpp_test = 0.
         model.to(master_device)
         with torch.no_grad():
             for normalizer in model.module.getNormalizers():
                 if type(normalizer) is MonotonicNormalizer:
                     normalizer.nb_steps = 150
-            for batch_idx, (cur_x, target) in enumerate(valid_loader):
-                cur_x = cur_x.view(batch_size, -1).float().to(master_device)
-                z, jac = model(cur_x)
-                ll = (model.module.z_log_density(z) + jac)
-                ll_test += ll.mean().item()
-                bpp_test += compute_bpp(ll, cur_x.view(batch_size, -1).float().to(master_device), alpha).mean().item()
-            ll_test /= batch_idx + 1
-            bpp_test /= batch_idx + 1
+            res = evaluate(model, valid_loader, alpha)
+            ll_test, bpp_test = res["ll"], res["bpp"]
             end = timer()
 
             dagness = max(model.module.DAGness())
@@ -249,54 +181,19 @@ def train(dataset="MNIST", load=True, nb_step_dual=100, nb_steps=20, path="", l1
                 "- Elapsed time per epoch {:4f} (seconds)".format(epoch, ll_tot, ll_test, bpp_test, dagness, end - start))
             if model.module.isInvertible() and -ll_test < best_valid_loss:
                 logger.info("------- New best validation loss --------")
-                torch.save(model.state_dict(), path + '/best_model.pt')
+                is_best = True
                 best_valid_loss = -ll_test
-                # Valid loop
-                ll_test = 0.
-                for batch_idx, (cur_x, target) in enumerate(test_loader):
-                    z, jac = model(cur_x.view(batch_size, -1).float().to(master_device))
-                    ll = (model.module.z_log_density(z) + jac)
-                    ll_test += ll.mean().item()
-                    bpp_test += compute_bpp(ll, cur_x.view(batch_size, -1).float().to(master_device), alpha).mean().item()
-
-                ll_test /= batch_idx + 1
-                bpp_test /= batch_idx + 1
+                # Test loop
+                res = evaluate(model, test_loader, alpha)
+                ll_test, bpp_test = res["ll"], res["bpp"]
                 logger.info("epoch: {:d} - Test log-likelihood: {:4f} - Test BPP {:4f} - <<DAGness>>: {:4f}".
                             format(epoch, ll_test, bpp_test, dagness))
             if epoch % 10 == 0 and conditioner_type is DAGConditioner:
-                stoch_gate, noise_gate, s_thresh = [], [], []
-                for conditioner in model.module.getConditioners():
-                    stoch_gate.append(conditioner.stoch_gate)
-                    noise_gate.append(conditioner.noise_gate)
-                    s_thresh.append(conditioner.s_thresh)
-                    conditioner.stoch_gate = False
-                    conditioner.noise_gate = False
-                    conditioner.s_thresh = True
-                for threshold in [.95, .5, .1, .01, .0001]:
-                    for conditioner in model.module.getConditioners():
-                        conditioner.h_thresh = threshold
-                    # Valid loop
-                    ll_test = 0.
-                    bpp_test = 0.
-                    for batch_idx, (cur_x, target) in enumerate(valid_loader):
-                        cur_x = cur_x.view(batch_size, -1).float().to(master_device)
-                        z, jac = model(cur_x)
-                        ll = (model.module.z_log_density(z) + jac)
-                        ll_test += ll.mean().item()
-                        bpp_test += compute_bpp(ll, cur_x.view(batch_size, -1).float().to(master_device), alpha).mean().item()
-                    ll_test /= batch_idx + 1
-                    bpp_test /= batch_idx + 1
-                    dagness = max(model.module.DAGness())
+                thresholds = [.95, .5, .1, .01, .0001]
+                res = threshold_sweep(model, valid_loader, thresholds, alpha)
+                for threshold, ll_test, bpp_test in zip(thresholds, res["ll"], res["bpp"]):
                     logger.info("epoch: {:d} - Threshold: {:4f} - Valid log-likelihood: {:4f} - Valid BPP {:4f} - <<DAGness>>: {:4f}".
                         format(epoch, threshold, ll_test, bpp_test, dagness))
-                for i, conditioner in enumerate(model.module.getConditioners()):
-                    conditioner.h_thresh = 0.
-                    conditioner.stoch_gate = stoch_gate[i]
-                    conditioner.noise_gate = noise_gate[i]
-                    conditioner.s_thresh = s_thresh[i]
-
-
-
 
                 in_s = 784 if dataset == "MNIST" else 3*32*32
                 a_tmp = model.module.getConditioners()[0].soft_thresholded_A()[0, :]
@@ -351,12 +248,9 @@ def train(dataset="MNIST", load=True, nb_step_dual=100, nb_steps=20, path="", l1
 
             if epoch % nb_step_dual == 0:
                 logger.info("Saving model N°%d" % epoch)
-                torch.save(model.state_dict(), path + '/model_%d.pt' % epoch)
-                torch.save(opt.state_dict(), path + '/ADAM_%d.pt' % epoch)
-
-            torch.save(model.state_dict(), path + '/model.pt')
-            torch.save(opt.state_dict(), path + '/ADAM.pt')
+            checkpoints.save(model, opt, epoch if epoch % nb_step_dual == 0 else None, best=is_best)
             torch.cuda.empty_cache()
+    checkpoints.wait()
 
 import argparse
 
@@ -367,12 +261,17 @@ parser.add_argument("-nb_steps_dual", default=100, type=int,
                     help="number of step between updating Acyclicity constraint and sparsity constraint")
 parser.add_argument("-l1", default=10., type=float, help="Maximum weight for l1 regularization")
 parser.add_argument("-nb_epoch", default=10000, type=int, help="Number of epochs")
+parser.add_argument("-keep_last", default=5, type=non_negative_int, help="Number of epoch checkpoints kept besides the best one.")
+parser.add_argument("-precision", default="fp32", choices=["fp32", "bf16"],
+                    help="Precision of the conditioner and integrand networks, bf16 requires torch >= 1.10.")
+parser.add_argument("-memory_budget", default=None, type=float,
+                    help="Approximate memory (MB) of the activations of one flow step, larger batches are split.")
 parser.add_argument("-b_size", default=1, type=int, help="Batch size")
 parser.add_argument("-int_net", default=[50, 50, 50], nargs="+", type=int, help="NN hidden layers of UMNN")
 parser.add_argument("-nb_steps", default=20, type=int, help="Number of integration steps.")
 parser.add_argument("-f_number", default=None, type=str, help="Number of heating steps.")
 parser.add_argument("-solver", default="CC", type=str, help="Which integral solver to use.",
-                    choices=["CC", "CCParallel"])
+                    choices=["CC", "CCParallel", "CCAdaptive"])
 parser.add_argument("-nb_flow", default=[1], nargs="+", type=int, help="Number of steps in the flow.")
 parser.add_argument("-test", default=False, action="store_true")
 parser.add_argument("-weight_decay", default=1e-5, type=float, help="Weight decay value")
@@ -399,4 +298,5 @@ train(dataset=args.dataset, load=args.load, path=path, nb_step_dual=args.nb_step
       nb_steps=args.nb_steps, file_number=args.f_number, norm_type=args.normalizer,
       solver=args.solver, train=not args.test, weight_decay=args.weight_decay, learning_rate=args.learning_rate,
       batch_per_optim_step=args.batch_per_optim_step, n_gpu=args.nb_gpus, hot_encoding=not args.no_hot_encoding,
-      prior_A_kernel=args.prior_A_kernel, conditioner=args.conditioner, emb_net=args.emb_net)
+      prior_A_kernel=args.prior_A_kernel, conditioner=args.conditioner, emb_net=args.emb_net, keep_last=args.keep_last,
+      precision=args.precision, memory_budget=args.memory_budget)
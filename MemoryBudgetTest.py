@@ -0,0 +1,75 @@
+import torch
+from models.Normalizers import *
+from models.Conditionners import *
+from models.NormalizingFlowFactories import buildFCNormalizingFlow, NormalLogDensity
+from models.NormalizingFlow import CNNormalizingFlow
+
+
+def build_flow(dim, normalizer_type, normalizer_args):
+    model = buildFCNormalizingFlow(2, DAGConditioner, {"in_size": dim, "hidden": [20, 20], "out_size": 5},
+                                   normalizer_type, normalizer_args)
+    with torch.no_grad():
+        for conditioner in model.getConditioners():
+            conditioner.A.data = torch.randn(dim, dim)
+            conditioner.stoch_gate = False
+    return model
+
+
+def test_threshold_sweep(dim=8, b_size=12, thresholds=[.95, .5, .1, .01, .0001]):
+    # The micro batches of a memory budget must keep the threshold blocks of a sweep aligned.
+    torch.manual_seed(0)
+    for normalizer_type, normalizer_args in [(AffineNormalizer, {}),
+                                             (MonotonicNormalizer, {"integrand_net": [20, 20], "cond_size": 5,
+                                                                    "nb_steps": 10})]:
+        model = build_flow(dim, normalizer_type, normalizer_args)
+        x = torch.randn(b_size, dim)
+        with torch.no_grad():
+            ll = model.threshold_sweep(x, thresholds)
+            for budget in [1, 3000, 10 ** 5]:
+                model.set_memory_budget(budget)
+                for max_rows in [None, 10]:
+                    ll_budget = model.threshold_sweep(x, thresholds, max_rows=max_rows)
+                    assert torch.allclose(ll, ll_budget, atol=1e-5), \
+                        "%s - Budget %d: the sweep differs by %e" % (normalizer_type.__name__, budget,
+                                                                    (ll - ll_budget).abs().max())
+            model.set_memory_budget(None)
+
+
+def test_gradients(dim=8, b_size=12):
+    torch.manual_seed(0)
+    model = build_flow(dim, AffineNormalizer, {})
+    x = torch.randn(b_size, dim)
+    grads = []
+    for budget in [None, 1]:
+        model.set_memory_budget(budget)
+        model.zero_grad()
+        z, jac = model(x)
+        model.loss(z, jac).backward()
+        grads.append([p.grad.clone() for p in model.parameters() if p.grad is not None])
+    model.set_memory_budget(None)
+    for g, g_budget in zip(*grads):
+        assert torch.allclose(g, g_budget, atol=1e-5), "The gradients differ by %e" % (g - g_budget).abs().max()
+
+
+def test_nested_sweep(b_size=5, thresholds=[.9, .3, .01]):
+    # Only the first inner step of a multi scale flow may share the first layer between the threshold blocks.
+    torch.manual_seed(0)
+    steps = []
+    for img_size in [[1, 4, 4], [1, 2, 2]]:
+        flow = build_flow(img_size[0] * img_size[1] * img_size[2], AffineNormalizer, {})
+        flow.img_sizes = img_size
+        steps.append(flow)
+    model = CNNormalizingFlow(steps, NormalLogDensity(), [[1, 2, 2], [1, 2, 2]])
+    x = torch.randn(b_size, 16)
+    with torch.no_grad():
+        ll = model.threshold_sweep(x, thresholds)
+        for i, threshold in enumerate(thresholds):
+            ll_threshold = model.threshold_sweep(x, [threshold])[0]
+            assert torch.allclose(ll[i], ll_threshold, atol=1e-5), \
+                "Threshold %f: the sweep differs by %e" % (threshold, (ll[i] - ll_threshold).abs().max())
+
+
+test_threshold_sweep()
+test_gradients()
+test_nested_sweep()
+print("Memory budget checks passed.")
@@ -0,0 +1,68 @@
+from timeit import default_timer as timer
+import torch
+from models.Normalizers import *
+from models.Conditionners import *
+from models.NormalizingFlowFactories import buildFCNormalizingFlow
+from lib.evaluation import evaluate
+
+
+def benchmark(dim=50, b_size=100, nb_batch=20, nb_flow=1, norm_type="monotonic", emb_net=[100, 100, 100, 10],
+              int_net=[100, 100, 100], nb_steps=20, hot_encoding=False):
+    device = "cpu" if not(torch.cuda.is_available()) else "cuda:0"
+    torch.manual_seed(0)
+    conditioner_args = {"in_size": dim, "hidden": emb_net[:-1], "out_size": emb_net[-1], "hot_encoding": hot_encoding}
+    if norm_type == "monotonic":
+        normalizer_type = MonotonicNormalizer
+        normalizer_args = {"integrand_net": int_net, "cond_size": emb_net[-1] + (dim if hot_encoding else 0),
+                           "nb_steps": nb_steps}
+    else:
+        normalizer_type = AffineNormalizer
+        normalizer_args = {}
+    model = buildFCNormalizingFlow(nb_flow, DAGConditioner, conditioner_args, normalizer_type, normalizer_args)
+    model.to(device)
+    x = torch.randn(nb_batch, b_size, dim, device=device)
+    init_state = {k: v.clone() for k, v in model.state_dict().items()}
+
+    res = {}
+    for precision, dtype in [("fp32", None), ("bf16", torch.bfloat16)]:
+        model.load_state_dict(init_state)
+        model.set_precision(dtype)
+        # Log-likelihood drift of the same weights.
+        res[precision] = {"ll": evaluate(model, x)["ll"]}
+        opt = torch.optim.Adam(model.parameters(), lr=1e-3)
+        for i in range(nb_batch + 2):
+            if i == 2:
+                if device != "cpu":
+                    torch.cuda.synchronize()
+                start = timer()
+            z, jac = model(x[i % nb_batch])
+            loss = model.loss(z, jac)
+            opt.zero_grad()
+            loss.backward()
+            opt.step()
+        if device != "cpu":
+            torch.cuda.synchronize()
+        res[precision]["samples_per_s"] = nb_batch * b_size / (timer() - start)
+    model.set_precision(None)
+
+    for precision, r in res.items():
+        print("%s - Train throughput: %.1f samples/s - Log-likelihood: %f - Drift w.r.t. fp32: %e" %
+              (precision, r["samples_per_s"], r["ll"], r["ll"] - res["fp32"]["ll"]))
+    return res
+
+
+import argparse
+
+parser = argparse.ArgumentParser(description='Throughput and log-likelihood drift of bf16 autocast against fp32.')
+parser.add_argument("-dim", default=50, type=int, help="Dimension of the data.")
+parser.add_argument("-b_size", default=100, type=int, help="Batch size")
+parser.add_argument("-nb_batch", default=20, type=int, help="Number of timed batches.")
+parser.add_argument("-nb_flow", type=int, default=1, help="Number of steps in the flow.")
+parser.add_argument("-normalizer", default="monotonic", choices=["affine", "monotonic"])
+parser.add_argument("-emb_net", default=[100, 100, 100, 10], nargs="+", type=int, help="NN layers of embedding")
+parser.add_argument("-int_net", default=[100, 100, 100], nargs="+", type=int, help="NN hidden layers of UMNN")
+parser.add_argument("-nb_steps", default=20, type=int, help="Number of integration steps.")
+
+args = parser.parse_args()
+benchmark(args.dim, args.b_size, args.nb_batch, args.nb_flow, args.normalizer, args.emb_net, args.int_net,
+          args.nb_steps)
@@ -0,0 +1,44 @@
+import torch
+from models.Normalizers import *
+from models.Conditionners import *
+from models.NormalizingFlowFactories import buildFCNormalizingFlow
+
+
+def test_post_processed_bf16(dim=6, b_size=20):
+    # One forward and backward step of post processed (sparse) flows under bf16 autocast.
+    if not hasattr(torch, "autocast"):
+        print("torch.autocast is not available, bf16 is not supported.")
+        return
+    for hot_encoding in [False, True]:
+        for normalizer_type, normalizer_args in [(AffineNormalizer, {}),
+                                                 (MonotonicNormalizer, {"integrand_net": [20, 20],
+                                                                        "cond_size": 5 + (dim if hot_encoding else 0),
+                                                                        "nb_steps": 10})]:
+            torch.manual_seed(0)
+            model = buildFCNormalizingFlow(2, DAGConditioner, {"in_size": dim, "hidden": [20, 20], "out_size": 5,
+                                                               "hot_encoding": hot_encoding},
+                                           normalizer_type, normalizer_args)
+            x = torch.randn(b_size, dim)
+            with torch.no_grad():
+                for conditioner in model.getConditioners():
+                    conditioner.A.data = torch.randn(dim, dim)
+                    conditioner.post_process(.5)
+                    assert conditioner.is_sparse()
+            losses = {}
+            for dtype in [None, torch.bfloat16]:
+                model.set_precision(dtype)
+                model.zero_grad()
+                z, jac = model(x)
+                loss = model.loss(z, jac)
+                loss.backward()
+                grads = [p.grad for p in model.parameters() if p.grad is not None]
+                assert len(grads) > 0 and all(torch.isfinite(g).all() for g in grads)
+                losses[dtype] = loss.item()
+            model.set_precision(None)
+            name = "%s - Hot encoding %s" % (normalizer_type.__name__, hot_encoding)
+            assert abs(losses[torch.bfloat16] - losses[None]) < 5e-2 * abs(losses[None]), \
+                "%s: the bf16 loss %f differs from the fp32 loss %f" % (name, losses[torch.bfloat16], losses[None])
+
+
+test_post_processed_bf16()
+print("bf16 checks passed.")
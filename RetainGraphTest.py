@@ -0,0 +1,52 @@
+import torch
+from models.Normalizers import *
+from models.Conditionners import *
+from models.NormalizingFlowFactories import buildFCNormalizingFlow
+
+
+def reference_constraint(conditioner):
+    # DAGness penalty with autograd through the plain matrix power, independent of PowerTrace.
+    alpha = min(1., conditioner.alpha) * conditioner.alpha_factor
+    B = torch.eye(conditioner.in_size) + alpha * conditioner.A ** 2
+    lag_const = torch.trace(torch.matrix_power(B, conditioner.exponent)) - conditioner.in_size
+    return conditioner.dag_const * (conditioner.lambd * lag_const + conditioner.c / 2 * lag_const ** 2) + \
+        conditioner.l1_weight * conditioner.A.abs().mean()
+
+
+def test_single_backward(dim=6, b_size=20, nb_batch=3):
+    # Each training step does one backward without retained graph, the dual parameters being updated and the
+    # optimizer stepping in between. The gradients must match the reference loss rebuilt from scratch at each step.
+    for normalizer_type, normalizer_args in [(AffineNormalizer, {}),
+                                             (MonotonicNormalizer, {"integrand_net": [20, 20], "cond_size": 5,
+                                                                    "nb_steps": 10})]:
+        torch.manual_seed(0)
+        model = buildFCNormalizingFlow(2, DAGConditioner, {"in_size": dim, "hidden": [20, 20], "out_size": 5,
+                                                           "l1": .1}, normalizer_type, normalizer_args)
+        for conditioner in model.getConditioners():
+            conditioner.stoch_gate = False
+        params = [p for p in model.parameters() if p.requires_grad]
+        opt = torch.optim.Adam(params, lr=1e-2)
+        for i in range(nb_batch):
+            x = torch.randn(b_size, dim)
+            z, jac = model(x)
+            nll = -(jac + model.z_log_density(z)).mean()
+            reference = nll + sum(reference_constraint(c) for c in model.getConditioners())
+            reference_grads = torch.autograd.grad(reference, params, allow_unused=True, retain_graph=True)
+
+            loss = model.loss(z, jac)
+            opt.zero_grad()
+            loss.backward()
+            name = "%s - Batch %d" % (normalizer_type.__name__, i)
+            assert torch.allclose(loss, reference, rtol=1e-5), "%s: the loss %f differs from %f" % \
+                                                              (name, loss.item(), reference.item())
+            for p, g in zip(params, reference_grads):
+                g = torch.zeros_like(p) if g is None else g
+                assert p.grad is not None and torch.allclose(p.grad, g, rtol=1e-4, atol=1e-6), \
+                    "%s: the gradients differ by %e" % (name, (p.grad - g).abs().max())
+            opt.step()
+            for conditioner in model.getConditioners():
+                conditioner.update_dual_param()
+
+
+test_single_backward()
+print("Single backward gradients match the reference.")
@@ -49,7 +49,8 @@ def train_toy(toy, load=True, nb_step_dual=300, nb_steps=15, folder="", l1=1., n
         conditioner_args["hot_encoding"] = True
     normalizer_type = norm_types[norm_type]
     if normalizer_type is MonotonicNormalizer:
-        normalizer_args = {"integrand_net": int_net, "cond_size": emb_net[-1], "nb_steps": nb_steps,
+        normalizer_args = {"integrand_net": int_net, "nb_steps": nb_steps,
+                           "cond_size": emb_net[-1] + (dim if conditioner_args.get("hot_encoding") else 0),
                            "solver": solver}
     else:
         normalizer_args = {}
@@ -86,7 +87,7 @@ def train_toy(toy, load=True, nb_step_dual=300, nb_steps=15, folder="", l1=1., n
                 print(ll.max(), z.max())
                 exit()
             opt.zero_grad()
-            loss.backward(retain_graph=True)
+            loss.backward()
             opt.step()
         model.step(epoch, loss_tot)
 
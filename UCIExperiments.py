@@ -1,5 +1,8 @@
 from timeit import default_timer as timer
 import lib.utils as utils
+from lib.evaluation import evaluate, threshold_sweep
+from lib.checkpoint import CheckpointManager, non_negative_int
+from lib.streaming import DeviceBatchStream, ShardStream
 from datetime import datetime
 import yaml
 import os
@@ -16,19 +19,23 @@ def batch_iter(X, batch_size, shuffle=False):
     """
     X: feature tensor (shape: num_instances x num_features)
     """
-    if shuffle:
-        idxs = torch.randperm(X.shape[0])
-    else:
-        idxs = torch.arange(X.shape[0])
+    if not shuffle:
+        for i in range(0, X.shape[0], batch_size):
+            yield X[i:i + batch_size]
+        return
+    idxs = torch.randperm(X.shape[0])
     if X.is_cuda:
         idxs = idxs.cuda()
     for batch_idxs in idxs.split(batch_size):
         yield X[batch_idxs]
 
 
-def load_data(name):
+def load_data(name, shards=None):
+
+    if name == 'shards':
+        return UCIdatasets.SHARDS(shards)
 
-    if name == 'bsds300':
+    elif name == 'bsds300':
         return UCIdatasets.BSDS300()
 
     elif name == 'power':
@@ -53,11 +60,14 @@ def load_data(name):
 
 cond_types = {"DAG": DAGConditioner, "Coupling": CouplingConditioner, "Autoregressive": AutoregressiveConditioner}
 norm_types = {"affine": AffineNormalizer, "monotonic": MonotonicNormalizer}
+precisions = {"fp32": None, "bf16": torch.bfloat16}
 
 
 def train(dataset="POWER", load=True, nb_step_dual=100, nb_steps=20, path="", l1=.1, nb_epoch=10000,
           int_net=[200, 200, 200], emb_net=[200, 200, 200], b_size=100, all_args=None, file_number=None, train=True,
-          solver="CC", nb_flow=1, weight_decay=1e-5, learning_rate=1e-3, cond_type='DAG', norm_type='affine'):
+          solver="CC", nb_flow=1, weight_decay=1e-5, learning_rate=1e-3, cond_type='DAG', norm_type='affine',
+          keep_last=5, precision="fp32",
+          memory_budget=None, stream=False, shards=None):
     logger = utils.get_logger(logpath=os.path.join(path, 'logs'), filepath=os.path.abspath(__file__))
     logger.info(str(all_args))
 
@@ -72,13 +82,16 @@ def train(dataset="POWER", load=True, nb_step_dual=100, nb_steps=20, path="", l1
     batch_size = b_size
 
     logger.info("Loading data...")
-    data = load_data(dataset)
-    data.trn.x = torch.from_numpy(data.trn.x).to(device)
-    data.val.x = torch.from_numpy(data.val.x).to(device)
-    data.tst.x = torch.from_numpy(data.tst.x).to(device)
+    data = load_data(dataset, shards)
+    # The shards are only read by chunks when streaming, the other datasets are moved to the device at once.
+    stream = stream or dataset == "shards"
+    if not stream:
+        data.trn.x = torch.from_numpy(data.trn.x).to(device)
+        data.val.x = torch.from_numpy(data.val.x).to(device)
+        data.tst.x = torch.from_numpy(data.tst.x).to(device)
     logger.info("Data loaded.")
 
-    dim = data.trn.x.shape[1]
+    dim = data.n_dims
     conditioner_type = cond_types[cond_type]
     conditioner_args = {"in_size": dim, "hidden": emb_net[:-1], "out_size": emb_net[-1]}
     if conditioner_type is DAGConditioner:
@@ -88,15 +101,19 @@ def train(dataset="POWER", load=True, nb_step_dual=100, nb_steps=20, path="", l1
         conditioner_args["hot_encoding"] = True
     normalizer_type = norm_types[norm_type]
     if normalizer_type is MonotonicNormalizer:
-        normalizer_args = {"integrand_net": int_net, "cond_size": emb_net[-1], "nb_steps": nb_steps,
+        normalizer_args = {"integrand_net": int_net, "nb_steps": nb_steps,
+                           "cond_size": emb_net[-1] + (dim if conditioner_args.get("hot_encoding") else 0),
                            "solver": solver}
     else:
         normalizer_args = {}
 
     model = buildFCNormalizingFlow(nb_flow, conditioner_type, conditioner_args, normalizer_type, normalizer_args)
+    model.set_precision(precisions[precision])
+    model.set_memory_budget(memory_budget * 2**20 if memory_budget is not None else None)
     best_valid_loss = np.inf
 
     opt = torch.optim.Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    checkpoints = CheckpointManager(path, keep_last=keep_last)
 
     if load:
         logger.info("Loading model...")
@@ -110,6 +127,15 @@ def train(dataset="POWER", load=True, nb_step_dual=100, nb_steps=20, path="", l1
                         if isinstance(v, torch.Tensor):
                             state[k] = v.cuda()
 
+    if stream:
+        train_stream = ShardStream(data.trn.x, batch_size, device, shuffle=True)
+        val_batches = lambda: ShardStream(data.val.x, batch_size, device, shuffle=False)
+        tst_batches = lambda: ShardStream(data.tst.x, batch_size, device, shuffle=False)
+    else:
+        train_stream = DeviceBatchStream(data.trn.x, batch_size, shuffle=True)
+        val_batches = lambda: batch_iter(data.val.x, batch_size=batch_size)
+        tst_batches = lambda: batch_iter(data.tst.x, batch_size=batch_size)
+
     #x = data.trn.x[:20]
     #print(x, model(x))
     #exit()
@@ -117,6 +143,7 @@ def train(dataset="POWER", load=True, nb_step_dual=100, nb_steps=20, path="", l1
     for epoch in range(nb_epoch):
         ll_tot = 0
         start = timer()
+        is_best = False
 
         # Update constraints
         if conditioner_type is DAGConditioner:
@@ -127,7 +154,7 @@ def train(dataset="POWER", load=True, nb_step_dual=100, nb_steps=20, path="", l1
         # Training loop
         model.to(device)
         if train:
-            for i, cur_x in enumerate(batch_iter(data.trn.x, shuffle=True, batch_size=batch_size)):
+            for i, cur_x in enumerate(train_stream):
                 if normalizer_type is MonotonicNormalizer:
                     for normalizer in model.getNormalizers():
                         normalizer.nb_steps = nb_steps + torch.randint(0, 10, [1])[0].item()
@@ -140,7 +167,7 @@ def train(dataset="POWER", load=True, nb_step_dual=100, nb_steps=20, path="", l1
                     exit()
                 ll_tot += loss.detach()
                 opt.zero_grad()
-                loss.backward(retain_graph=True)
+                loss.backward()
                 opt.step()
 
             ll_tot /= i + 1
@@ -150,16 +177,11 @@ def train(dataset="POWER", load=True, nb_step_dual=100, nb_steps=20, path="", l1
 
 
         # Valid loop
-        ll_test = 0.
         with torch.no_grad():
             if normalizer_type is MonotonicNormalizer:
                 for normalizer in model.getNormalizers():
                     normalizer.nb_steps = nb_steps + 20
-            for i, cur_x in enumerate(batch_iter(data.val.x, shuffle=True, batch_size=batch_size)):
-                z, jac = model(cur_x)
-                ll = (model.z_log_density(z) + jac)
-                ll_test += ll.mean().item()
-            ll_test /= i + 1
+            ll_test = evaluate(model, val_batches())["ll"]
 
             end = timer()
             dagness = max(model.DAGness())
@@ -168,59 +190,28 @@ def train(dataset="POWER", load=True, nb_step_dual=100, nb_steps=20, path="", l1
 
             if dagness < 1e-20 and -ll_test < best_valid_loss:
                 logger.info("------- New best validation loss --------")
-                torch.save(model.state_dict(), path + '/best_model.pt')
+                is_best = True
                 best_valid_loss = -ll_test
-                # Valid loop
-                ll_test = 0.
-                for i, cur_x in enumerate(batch_iter(data.tst.x, shuffle=True, batch_size=batch_size)):
-                    z, jac = model(cur_x)
-                    ll = (model.z_log_density(z) + jac)
-                    ll_test += ll.mean().item()
-                ll_test /= i + 1
+                # Test loop
+                ll_test = evaluate(model, tst_batches())["ll"]
 
                 logger.info("epoch: {:d} - Test log-likelihood: {:4f} - <<DAGness>>: {:4f}".format(epoch, ll_test,
                                                                                                    dagness))
             if epoch % 10 == 0 and conditioner_type is DAGConditioner:
-                stoch_gate, noise_gate, s_thresh = [], [], []
-
-                for conditioner in model.getConditioners():
-                    stoch_gate.append(conditioner.stoch_gate)
-                    noise_gate.append(conditioner.noise_gate)
-                    s_thresh.append(conditioner.s_thresh)
-                    conditioner.stoch_gate = False
-                    conditioner.noise_gate = False
-                    conditioner.s_thresh = True
-                for threshold in [.95, .5, .1, .01, .0001]:
-                    for conditioner in model.getConditioners():
-                        conditioner.h_thresh = threshold
-                    # Valid loop
-                    ll_test = 0.
-                    for i, cur_x in enumerate(batch_iter(data.val.x, shuffle=True, batch_size=batch_size)):
-                        z, jac = model(cur_x)
-                        ll = (model.z_log_density(z) + jac)
-                        ll_test += ll.mean().item()
-                    ll_test /= i
-                    dagness = max(model.DAGness())
+                thresholds = [.95, .5, .1, .01, .0001]
+                ll_sweep = threshold_sweep(model, val_batches(), thresholds)["ll"]
+                for threshold, ll_test in zip(thresholds, ll_sweep):
                     logger.info("epoch: {:d} - Threshold: {:4f} - Valid log-likelihood: {:4f} - <<DAGness>>: {:4f}".
                                 format(epoch, threshold, ll_test, dagness))
 
-
-                for i, conditioner in enumerate(model.getConditioners()):
-                    conditioner.h_thresh = threshold
-                    conditioner.stoch_gate = stoch_gate[i]
-                    conditioner.noise_gate = noise_gate[i]
-                    conditioner.s_thresh = s_thresh[i]
-
-            torch.save(model.state_dict(), path + '/model_%d.pt' % epoch)
-            torch.save(opt.state_dict(), path + '/ADAM_%d.pt' % epoch)
             if dataset == "proteins" and conditioner_type is DAGConditioner:
                 torch.save(model.getConditioners[0].soft_thresholded_A().detach().cpu(), path + '/A_%d.pt' % epoch)
 
-        torch.save(model.state_dict(), path + '/model.pt')
-        torch.save(opt.state_dict(), path + '/ADAM.pt')
+        checkpoints.save(model, opt, epoch, best=is_best)
+    checkpoints.wait()
 
 import argparse
-datasets = ["power", "gas", "bsds300", "miniboone", "hepmass", "digits", "proteins"]
+datasets = ["power", "gas", "bsds300", "miniboone", "hepmass", "digits", "proteins", "shards"]
 
 parser = argparse.ArgumentParser(description='')
 parser.add_argument("-load_config", default=None, type=str)
@@ -228,6 +219,10 @@ parser.add_argument("-load_config", default=None, type=str)
 parser.add_argument("-dataset", default=None, choices=datasets, help="Which toy problem ?")
 parser.add_argument("-load", default=False, action="store_true", help="Load a model ?")
 parser.add_argument("-folder", default="", help="Folder")
+parser.add_argument("-shards", default=None, type=str,
+                    help="Folder with trn/, val/ and tst/ subfolders of float32 .npy shards for the shards dataset.")
+parser.add_argument("-stream", default=False, action="store_true",
+                    help="Read the memory mapped data by chunks instead of moving it to the device at once.")
 parser.add_argument("-f_number", default=None, type=str, help="Number of heating steps.")
 parser.add_argument("-test", default=False, action="store_true")
 parser.add_argument("-nb_flow", type=int, default=1, help="Number of steps in the flow.")
@@ -236,6 +231,11 @@ parser.add_argument("-nb_flow", type=int, default=1, help="Number of steps in th
 parser.add_argument("-weight_decay", default=1e-5, type=float, help="Weight decay value")
 parser.add_argument("-learning_rate", default=1e-3, type=float, help="Weight decay value")
 parser.add_argument("-nb_epoch", default=10000, type=int, help="Number of epochs")
+parser.add_argument("-keep_last", default=5, type=non_negative_int, help="Number of epoch checkpoints kept besides the best one.")
+parser.add_argument("-precision", default="fp32", choices=["fp32", "bf16"],
+                    help="Precision of the conditioner and integrand networks, bf16 requires torch >= 1.10.")
+parser.add_argument("-memory_budget", default=None, type=float,
+                    help="Approximate memory (MB) of the activations of one flow step, larger batches are split.")
 parser.add_argument("-b_size", default=100, type=int, help="Batch size")
 
 # Conditioner Parameters
@@ -251,7 +251,7 @@ parser.add_argument("-normalizer", default='affine', choices=['affine', 'monoton
 parser.add_argument("-int_net", default=[100, 100, 100, 100], nargs="+", type=int, help="NN hidden layers of UMNN")
 parser.add_argument("-nb_steps", default=20, type=int, help="Number of integration steps.")
 parser.add_argument("-solver", default="CC", type=str, help="Which integral solver to use.",
-                    choices=["CC", "CCParallel"])
+                    choices=["CC", "CCParallel", "CCAdaptive"])
 
 args = parser.parse_args()
 
@@ -275,6 +275,8 @@ if args.load_config is not None:
                 setattr(args, key, val)
         except yaml.YAMLError as exc:
             print(exc)
+if args.dataset == "shards" and args.shards is None:
+    parser.error("-shards is required with -dataset shards")
 
 
 dir_name = args.dataset if args.load_config is None else args.load_config
@@ -285,4 +287,5 @@ train(args.dataset, load=args.load, path=path, nb_step_dual=args.nb_steps_dual,
       int_net=args.int_net, emb_net=args.emb_net, b_size=args.b_size, all_args=args,
       nb_steps=args.nb_steps, file_number=args.f_number,  solver=args.solver, nb_flow=args.nb_flow,
       train=not args.test, weight_decay=args.weight_decay, learning_rate=args.learning_rate,
-      cond_type=args.conditioner,  norm_type=args.normalizer)
+      cond_type=args.conditioner,  norm_type=args.normalizer, keep_last=args.keep_last,
+      precision=args.precision, memory_budget=args.memory_budget, stream=args.stream, shards=args.shards)
@@ -7,3 +7,4 @@ from .miniboone import MINIBOONE
 from .bsds300 import BSDS300
 from .digits import DIGITS
 from .proteins import PROTEINS, get_shd
+from .shards import SHARDS
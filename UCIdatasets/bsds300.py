@@ -2,6 +2,7 @@ import numpy as np
 import h5py
 
 import UCIdatasets as datasets
+from .cache import load_cached
 
 
 class BSDS300:
@@ -22,13 +23,21 @@ class BSDS300:
     def __init__(self):
 
         # load dataset
-        f = h5py.File(datasets.root + 'BSDS300/BSDS300.hdf5', 'r')
+        file = datasets.root + 'BSDS300/BSDS300.hdf5'
+        trn, val, tst, _ = load_cached('bsds300', load_data, [file], file)
 
-        self.trn = self.Data(f['train'])
-        self.val = self.Data(f['validation'])
-        self.tst = self.Data(f['test'])
+        self.trn = self.Data(trn)
+        self.val = self.Data(val)
+        self.tst = self.Data(tst)
 
         self.n_dims = self.trn.x.shape[1]
         self.image_size = [int(np.sqrt(self.n_dims + 1))] * 2
 
-        f.close()
+
+def load_data(file):
+
+    f = h5py.File(file, 'r')
+    data = f['train'][:], f['validation'][:], f['test'][:]
+    f.close()
+
+    return data
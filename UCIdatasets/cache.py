@@ -0,0 +1,55 @@
+import os
+import sys
+import shutil
+import hashlib
+import inspect
+import numpy as np
+
+import UCIdatasets as datasets
+
+SPLITS = ['trn', 'val', 'tst']
+
+
+def cache_key(loader, sources):
+    """
+    Hash of the source code of the module defining loader and of this module, which defines the cache format, and of
+    the path, size and modification time of the source files, such that editing any of them invalidates the cache.
+    """
+    h = hashlib.sha1(inspect.getsource(sys.modules[loader.__module__]).encode())
+    h.update(inspect.getsource(sys.modules[__name__]).encode())
+    for f in sources:
+        st = os.stat(f)
+        h.update(("%s:%d:%d" % (os.path.abspath(f), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()[:16]
+
+
+def load_cached(name, loader, sources, *args):
+    """
+    Returns the train, validation and test splits given by loader(*args) as float32 arrays memory mapped (copy on
+    write) from datasets.root + 'cache/name/', and the dict of the normalisation parameters (e.g. mean and std) the
+    loader may return as a fourth value. The splits are computed once for each cache_key and written with these
+    parameters and the size of each split in stats.npz, the caches of previous keys are removed.
+    """
+    cache_dir = os.path.join(datasets.root, 'cache', name)
+    path = os.path.join(cache_dir, cache_key(loader, sources))
+    if not os.path.isfile(os.path.join(path, 'stats.npz')):
+        splits = loader(*args)
+        stats = dict(splits[3]) if len(splits) > 3 else {}
+        tmp = path + '.tmp%d' % os.getpid()
+        os.makedirs(tmp, exist_ok=True)
+        for split, data in zip(SPLITS, splits):
+            data = np.asarray(data, dtype=np.float32)
+            np.save(os.path.join(tmp, split + '.npy'), data)
+            stats[split + '_N'] = data.shape[0]
+        np.savez(os.path.join(tmp, 'stats.npz'), **stats)
+        for old in os.listdir(cache_dir):
+            if old != os.path.basename(tmp) and '.tmp' not in old:
+                shutil.rmtree(os.path.join(cache_dir, old), ignore_errors=True)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Written in the meantime by another run.
+            shutil.rmtree(tmp)
+    with np.load(os.path.join(path, 'stats.npz')) as f:
+        stats = {k: f[k] for k in f.files if not k.endswith('_N')}
+    return [np.load(os.path.join(path, split + '.npy'), mmap_mode='c') for split in SPLITS] + [stats]
@@ -2,6 +2,7 @@ import pandas as pd
 import numpy as np
 
 import UCIdatasets as datasets
+from .cache import load_cached
 
 
 class GAS:
@@ -10,19 +11,21 @@ class GAS:
 
         def __init__(self, data):
 
-            self.x = data.astype(np.float32)
+            self.x = data.astype(np.float32, copy=False)
             self.N = self.x.shape[0]
 
     def __init__(self):
 
         file = datasets.root + 'gas/ethylene_CO.pickle'
-        trn, val, tst = load_data_and_clean_and_split(file)
+        trn, val, tst, stats = load_cached('gas', load_data_and_clean_and_split, [file], file)
 
         self.trn = self.Data(trn)
         self.val = self.Data(val)
         self.tst = self.Data(tst)
 
         self.n_dims = self.trn.x.shape[1]
+        # Parameters of the normalisation of the data.
+        self.mean, self.std = stats['mean'], stats['std']
 
 
 def load_data(file):
@@ -36,32 +39,37 @@ def load_data(file):
     return data
 
 
-def get_correlation_numbers(data):
-    C = data.corr()
-    A = C > 0.98
-    B = A.as_matrix().sum(axis=1)
-    return B
+def get_columns_to_remove(C, threshold=0.98):
+    """
+    Greedily removes the first column correlated above threshold with another remaining one, until none is left. The
+    correlation of two columns does not depend on the other ones, so this only needs the correlation matrix C once.
+    """
+    A = np.asarray(C) > threshold
+    keep = np.ones(A.shape[0], dtype=bool)
+    while True:
+        B = (A & keep).sum(axis=1)
+        correlated = np.where(keep & (B > 1))[0]
+        if correlated.shape[0] == 0:
+            return np.where(~keep)[0]
+        keep[correlated[0]] = False
 
 
 def load_data_and_clean(file):
 
     data = load_data(file)
-    B = get_correlation_numbers(data)
-
-    while np.any(B > 1):
-        col_to_remove = np.where(B > 1)[0][0]
-        col_name = data.columns[col_to_remove]
-        data.drop(col_name, axis=1, inplace=True)
-        B = get_correlation_numbers(data)
+    col_to_remove = get_columns_to_remove(data.corr())
+    data.drop(data.columns[col_to_remove], axis=1, inplace=True)
     # print(data.corr())
-    data = (data - data.mean()) / data.std()
+    mu, s = data.mean(), data.std()
+    data = (data - mu) / s
 
-    return data
+    return data, mu.values, s.values
 
 
 def load_data_and_clean_and_split(file):
 
-    data = load_data_and_clean(file).as_matrix()
+    data, mu, s = load_data_and_clean(file)
+    data = data.values
     N_test = int(0.1 * data.shape[0])
     data_test = data[-N_test:]
     data_train = data[0:-N_test]
@@ -69,4 +77,4 @@ def load_data_and_clean_and_split(file):
     data_validate = data_train[-N_validate:]
     data_train = data_train[0:-N_validate]
 
-    return data_train, data_validate, data_test
+    return data_train, data_validate, data_test, {'mean': mu, 'std': s}
@@ -4,6 +4,7 @@ from collections import Counter
 from os.path import join
 
 import UCIdatasets as datasets
+from .cache import load_cached
 
 
 class HEPMASS:
@@ -16,19 +17,22 @@ class HEPMASS:
 
         def __init__(self, data):
 
-            self.x = data.astype(np.float32)
+            self.x = data.astype(np.float32, copy=False)
             self.N = self.x.shape[0]
 
     def __init__(self):
 
         path = datasets.root + 'hepmass/'
-        trn, val, tst = load_data_no_discrete_normalised_as_array(path)
+        trn, val, tst, stats = load_cached('hepmass', load_data_no_discrete_normalised_as_array,
+                                    [join(path, "1000_train.csv"), join(path, "1000_test.csv")], path)
 
         self.trn = self.Data(trn)
         self.val = self.Data(val)
         self.tst = self.Data(tst)
 
         self.n_dims = self.trn.x.shape[1]
+        # Parameters of the normalisation of the data.
+        self.mean, self.std = stats['mean'], stats['std']
 
 
 def load_data(path):
@@ -64,13 +68,13 @@ def load_data_no_discrete_normalised(path):
     data_train = (data_train - mu) / s
     data_test = (data_test - mu) / s
 
-    return data_train, data_test
+    return data_train, data_test, mu, s
 
 
 def load_data_no_discrete_normalised_as_array(path):
 
-    data_train, data_test = load_data_no_discrete_normalised(path)
-    data_train, data_test = data_train.as_matrix(), data_test.as_matrix()
+    data_train, data_test, mu, s = load_data_no_discrete_normalised(path)
+    data_train, data_test = data_train.values, data_test.values
 
     i = 0
     # Remove any features that have too many re-occurring real values.
@@ -81,12 +85,13 @@ def load_data_no_discrete_normalised_as_array(path):
         if max_count > 5:
             features_to_remove.append(i)
         i += 1
-    data_train = data_train[:, np.array([i for i in range(data_train.shape[1]) if i not in features_to_remove])]
-    data_test = data_test[:, np.array([i for i in range(data_test.shape[1]) if i not in features_to_remove])]
+    features = np.array([i for i in range(data_train.shape[1]) if i not in features_to_remove])
+    data_train = data_train[:, features]
+    data_test = data_test[:, features]
 
     N = data_train.shape[0]
     N_validate = int(N * 0.1)
     data_validate = data_train[-N_validate:]
     data_train = data_train[0:-N_validate]
 
-    return data_train, data_validate, data_test
+    return data_train, data_validate, data_test, {'mean': mu.values[features], 'std': s.values[features]}
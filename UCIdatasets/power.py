@@ -1,6 +1,7 @@
 import numpy as np
 
 import UCIdatasets as datasets
+from .cache import load_cached
 
 
 class POWER:
@@ -9,18 +10,20 @@ class POWER:
 
         def __init__(self, data):
 
-            self.x = data.astype(np.float32)
+            self.x = data.astype(np.float32, copy=False)
             self.N = self.x.shape[0]
 
     def __init__(self):
 
-        trn, val, tst = load_data_normalised()
+        trn, val, tst, stats = load_cached('power', load_data_normalised, [datasets.root + 'power/data.npy'])
 
         self.trn = self.Data(trn)
         self.val = self.Data(val)
         self.tst = self.Data(tst)
 
         self.n_dims = self.trn.x.shape[1]
+        # Parameters of the normalisation of the data.
+        self.mean, self.std = stats['mean'], stats['std']
 
 
 def load_data():
@@ -81,4 +84,4 @@ def load_data_normalised():
     data_validate = (data_validate - mu) / s
     data_test = (data_test - mu) / s
 
-    return data_train, data_validate, data_test
+    return data_train, data_validate, data_test, {'mean': mu, 'std': s}
@@ -0,0 +1,34 @@
+import os
+import glob
+import numpy as np
+
+from .cache import SPLITS
+
+
+class SHARDS:
+    """
+    A tabular dataset stored as float32 .npy shards in path/trn/, path/val/ and path/tst/, already normalised. The
+    shards are memory mapped (read only) and never concatenated, x being the list of the shards of a split.
+    """
+
+    class Data:
+
+        def __init__(self, files):
+
+            self.x = [np.load(f, mmap_mode='r') for f in files]
+            for shard in self.x:
+                if shard.dtype != np.float32 or shard.ndim != 2:
+                    raise ValueError('Shards must be 2d float32 arrays, got %s %s.' % (shard.dtype, shard.shape))
+            self.N = sum(shard.shape[0] for shard in self.x)
+
+    def __init__(self, path):
+
+        data = []
+        for split in SPLITS:
+            files = sorted(glob.glob(os.path.join(path, split, '*.npy')))
+            if len(files) == 0:
+                raise ValueError('No .npy shard in %s.' % os.path.join(path, split))
+            data.append(self.Data(files))
+        self.trn, self.val, self.tst = data
+
+        self.n_dims = self.trn.x[0].shape[1]
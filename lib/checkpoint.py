@@ -0,0 +1,128 @@
+import os
+import copy
+import argparse
+import shutil
+import threading
+import torch
+
+
+class CheckpointManager(object):
+    """Saves the model and optimizer states in a background thread.
+
+    The states are first copied to CPU buffers, pinned when CUDA is available and reused between saves, such that
+    training can go on while they are written. Each checkpoint is written once, to model_%d.pt and ADAM_%d.pt when an
+    epoch is given, and model.pt, ADAM.pt and best_model.pt are hard links atomically renamed over the previous ones.
+    Only the keep_last most recent epoch checkpoints and the best one are kept, all of them if keep_last is None.
+    """
+
+    def __init__(self, path, keep_last=5, pin_memory=None):
+        if keep_last is not None and keep_last < 0:
+            raise ValueError("keep_last must be non negative, got %d." % keep_last)
+        self.path = path
+        self.keep_last = keep_last
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.epochs = []
+        self.best_epoch = None
+        self._buffers = {}
+        self._thread = None
+        self._error = None
+
+    def save(self, model, opt, epoch=None, best=False):
+        self.wait()
+        states = {"model": self._snapshot(model.state_dict(), ("model",)),
+                  "ADAM": self._snapshot(opt.state_dict(), ("ADAM",))}
+        event = None
+        if self.pin_memory:
+            event = torch.cuda.Event()
+            event.record()
+        self._thread = threading.Thread(target=self._run, args=(states, epoch, best, event))
+        self._thread.start()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self, states, epoch, best, event):
+        try:
+            if event is not None:
+                event.synchronize()
+            self._write(states, epoch, best)
+        except Exception as e:
+            self._error = e
+
+    def _write(self, states, epoch, best):
+        for name, state in states.items():
+            latest = os.path.join(self.path, name + ".pt")
+            if epoch is None:
+                _atomic_save(state, latest)
+                src = latest
+            else:
+                src = os.path.join(self.path, "%s_%d.pt" % (name, epoch))
+                _atomic_save(state, src)
+                _atomic_link(src, latest)
+            if best and name == "model":
+                _atomic_link(src, os.path.join(self.path, "best_model.pt"))
+        if best:
+            self.best_epoch = epoch
+        if epoch is not None:
+            self.epochs.append(epoch)
+        self._apply_retention()
+
+    def _apply_retention(self):
+        if self.keep_last is None:
+            return
+        keep = set(self.epochs[len(self.epochs) - self.keep_last:] + [self.best_epoch])
+        for epoch in self.epochs:
+            if epoch not in keep:
+                for name in ["model", "ADAM"]:
+                    f = os.path.join(self.path, "%s_%d.pt" % (name, epoch))
+                    if os.path.isfile(f):
+                        os.remove(f)
+        self.epochs = [epoch for epoch in self.epochs if epoch in keep]
+
+    def _snapshot(self, obj, key):
+        if torch.is_tensor(obj):
+            if obj.is_sparse:
+                return obj.detach().to("cpu", copy=True)
+            buf = self._buffers.get(key)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=self.pin_memory)
+                self._buffers[key] = buf
+            return buf.copy_(obj.detach(), non_blocking=self.pin_memory)
+        if isinstance(obj, dict):
+            res = type(obj)((k, self._snapshot(v, key + (k,))) for k, v in obj.items())
+            if hasattr(obj, "_metadata"):
+                res._metadata = copy.deepcopy(obj._metadata)
+            return res
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, key + (i,)) for i, v in enumerate(obj))
+        return copy.deepcopy(obj)
+
+
+def _atomic_save(obj, filename):
+    tmp = filename + ".tmp"
+    torch.save(obj, tmp)
+    os.replace(tmp, filename)
+
+
+def _atomic_link(src, dst):
+    tmp = dst + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def non_negative_int(value):
+    # argparse type of -keep_last.
+    value = int(value)
+    if value < 0:
+        raise argparse.ArgumentTypeError("%d is negative" % value)
+    return value
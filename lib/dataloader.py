@@ -1,131 +1,137 @@
 import torch
-from torchvision import datasets, transforms
-from lib.transform import AddUniformNoise, ToTensor, HorizontalFlip, Transpose, Resize
+import torch.nn.functional as F
+from torchvision import datasets
+from lib.transform import dequantize, random_hflip
+
+
+def images_to_tensor(data_set, size=None):
+    """
+    Returns the images of a torchvision dataset as one uint8 tensor [N, C, H, W], resized to size x size with a
+    bilinear interpolation if given.
+    """
+    data = torch.as_tensor(data_set.data)
+    data = data.unsqueeze(1) if data.dim() == 3 else data.permute(0, 3, 1, 2).contiguous()
+    if size is not None and list(data.shape[2:]) != [size, size]:
+        data = F.interpolate(data.float(), size=[size, size], mode='bilinear', align_corners=False)
+        data = data.round_().clamp_(0, 255).byte()
+    return data
+
+
+def load_mnist(size=None, label=None, nb_train=50000, device="cpu"):
+    """
+    Returns the train, validation and test splits of MNIST as TensorDatasets of uint8 images and targets on device,
+    keeping only the digits label if given. nb_train images of the training set are randomly kept for training, the
+    others for validation.
+    """
+    splits = []
+    for train in [True, False]:
+        data_set = datasets.MNIST('./MNIST', train=train, download=True)
+        x, y = images_to_tensor(data_set, size), torch.as_tensor(data_set.targets)
+        if label is not None:
+            x, y = x[y == label], y[y == label]
+        splits.append((x.to(device), y.to(device)))
+    (x, y), (x_test, y_test) = splits
+    perm = torch.randperm(x.shape[0], device=x.device)
+    return (torch.utils.data.TensorDataset(x[perm[:nb_train]], y[perm[:nb_train]]),
+            torch.utils.data.TensorDataset(x[perm[nb_train:]], y[perm[nb_train:]]),
+            torch.utils.data.TensorDataset(x_test, y_test))
+
+
+class HorizontalFlipDataset(torch.utils.data.Dataset):
+    """
+    The uint8 images data [N, C, H, W] followed by their horizontal flips, without copying them: item i is image i % N
+    flipped if i >= N. Can be indexed by a tensor of indices to get a batch.
+    """
+    def __init__(self, data, targets):
+        self.data = data
+        self.targets = targets
+
+    def __len__(self):
+        return 2 * self.data.shape[0]
+
+    def __getitem__(self, idx):
+        N = self.data.shape[0]
+        x, y = self.data[idx % N], self.targets[idx % N]
+        if torch.is_tensor(idx) and idx.dim() > 0:
+            return torch.where((idx >= N).view(-1, 1, 1, 1).to(x.device), x.flip(-1), x), y
+        return (x.flip(-1) if idx >= N else x), y
+
+
+def tensor_subset(data_set, subset):
+    # Subset of data_set with the indices of subset stored in a tensor, such that it can be indexed by batches.
+    return torch.utils.data.Subset(data_set, torch.as_tensor(subset.indices))
+
+
+class TensorImageLoader(object):
+    """
+    Iterates by (x, target) batches over a dataset of uint8 images [C, H, W] that can be indexed by a tensor of
+    indices, e.g. a TensorDataset, a HorizontalFlipDataset or a tensor_subset of them, whose tensors are on the
+    training device. The dequantization noise, the logit transform (see lib.transform.dequantize, skipped if alpha is
+    None) and the random horizontal flips are applied to each batch at once, instead of to each image by the workers
+    of a DataLoader.
+    """
+    def __init__(self, data_set, batch_size, alpha=1E-6, hflip=False, shuffle=True, drop_last=False):
+        self.data_set = data_set
+        self.batch_size = batch_size
+        self.alpha = alpha
+        self.hflip = hflip
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.data_set) // self.batch_size
+        return (len(self.data_set) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        N = len(self.data_set)
+        idx = torch.randperm(N) if self.shuffle else torch.arange(N)
+        end = len(self) * self.batch_size if self.drop_last else N
+        for i in range(0, end, self.batch_size):
+            x, y = self.data_set[idx[i:i + self.batch_size]]
+            if self.hflip:
+                x = random_hflip(x)
+            yield dequantize(x, self.alpha), y
+
 
 def dataloader(dataset, batch_size, cuda, conditionnal=False):
 
+    device = "cuda:%d" % cuda if cuda > -1 else "cpu"
+
     if dataset == 'CIFAR10':
-        data = datasets.CIFAR10('./CIFAR10', train=True, download=True,
-                       transform=transforms.Compose([
-                           AddUniformNoise(0.05),
-                           Transpose(),
-                           ToTensor()
-                       ]))
-
-        data_hflip = datasets.CIFAR10('./CIFAR10', train=True, download=True,
-                           transform=transforms.Compose([
-                           HorizontalFlip(), 
-                           AddUniformNoise(0.05),
-                           Transpose(),
-                           ToTensor()
-                       ]))
-        data = torch.utils.data.ConcatDataset([data, data_hflip])
+        data = datasets.CIFAR10('./CIFAR10', train=True, download=True)
+        data = HorizontalFlipDataset(images_to_tensor(data).to(device), torch.as_tensor(data.targets).to(device))
 
         train_data, valid_data = torch.utils.data.random_split(data, [90000, 10000])
+        train_data, valid_data = tensor_subset(data, train_data), tensor_subset(data, valid_data)
 
-        test_data = datasets.CIFAR10('./CIFAR10', train=False, download=True,
-                        transform=transforms.Compose([
-                            AddUniformNoise(0.05),
-                            Transpose(),
-                            ToTensor()
-                       ]))
+        test_data = datasets.CIFAR10('./CIFAR10', train=False, download=True)
+        test_data = torch.utils.data.TensorDataset(images_to_tensor(test_data).to(device),
+                                                   torch.as_tensor(test_data.targets).to(device))
+        alpha = 0.05
 
     elif dataset == 'MNIST':
-        data = datasets.MNIST('./MNIST', train=True, download=True,
-                   transform=transforms.Compose([
-                       AddUniformNoise(),
-                       ToTensor()
-                   ]))
-
-
-        train_data, valid_data = torch.utils.data.random_split(data, [50000, 10000])
- 
-        test_data = datasets.MNIST('./MNIST', train=False, download=True,
-                    transform=transforms.Compose([
-                        AddUniformNoise(),
-                        ToTensor()
-                    ]))
-
-
+        train_data, valid_data, test_data = load_mnist(device=device)
+        alpha = 1E-6
 
     elif len(dataset) == 6 and dataset[:5] == 'MNIST':
-        data = datasets.MNIST('./MNIST', train=True, download=True,
-                              transform=transforms.Compose([
-                                  AddUniformNoise(),
-                                  ToTensor()
-                              ]))
-        label = int(dataset[5])
-        idx = data.train_labels == label
-        data.train_labels = data.train_labels[idx]
-        data.train_data = data.train_data[idx]
-
-        train_data, valid_data = torch.utils.data.random_split(data, [5000, idx.sum() - 5000])
-
-        test_data = datasets.MNIST('./MNIST', train=False, download=True,
-                                   transform=transforms.Compose([
-                                       AddUniformNoise(),
-                                       ToTensor()
-                                   ]))
-        idx = test_data.test_labels == label
-        test_data.test_labels = test_data.test_labels[idx]
-        test_data.test_data = test_data.test_data[idx]
+        train_data, valid_data, test_data = load_mnist(label=int(dataset[5]), nb_train=5000, device=device)
+        alpha = 1E-6
+
     elif dataset == 'MNIST32':
-        data = datasets.MNIST('./MNIST', train=True, download=True,
-                              transform=transforms.Compose([
-                                  Resize(),
-                                  AddUniformNoise(),
-                                  ToTensor()
-                              ]))
-
-        train_data, valid_data = torch.utils.data.random_split(data, [50000, 10000])
-
-
-        test_data = datasets.MNIST('./MNIST', train=False, download=True,
-                                   transform=transforms.Compose([
-                                       Resize(),
-                                       AddUniformNoise(),
-                                       ToTensor()
-                                   ]))
+        train_data, valid_data, test_data = load_mnist(size=32, device=device)
+        alpha = 1E-6
+
     elif len(dataset) == 8 and dataset[:7] == 'MNIST32':
-        data = datasets.MNIST('./MNIST', train=True, download=True,
-                              transform=transforms.Compose([
-                                  Resize(),
-                                  AddUniformNoise(),
-                                  ToTensor()
-                              ]))
-
-        label = int(dataset[7])
-        idx = data.train_labels == label
-        data.train_labels = data.train_labels[idx]
-        data.train_data = data.train_data[idx]
-
-        train_data, valid_data = torch.utils.data.random_split(data, [5000, idx.sum() - 5000])
-
-        test_data = datasets.MNIST('./MNIST', train=False, download=True,
-                                   transform=transforms.Compose([
-                                       Resize(),
-                                       AddUniformNoise(),
-                                       ToTensor()
-                                   ]))
-        idx = test_data.test_labels == label
-        test_data.test_labels = test_data.test_labels[idx]
-        test_data.test_data = test_data.test_data[idx]
+        train_data, valid_data, test_data = load_mnist(size=32, label=int(dataset[7]), nb_train=5000, device=device)
+        alpha = 1E-6
+
     else:  
         print ('what network ?', args.net)
         sys.exit(1)
 
-    #load data 
-    kwargs = {'num_workers': 0, 'pin_memory': True} if cuda > -1 else {}
-
-    train_loader = torch.utils.data.DataLoader(
-        train_data,
-        batch_size=batch_size, shuffle=True, **kwargs)
+    train_loader = TensorImageLoader(train_data, batch_size, alpha)
+    valid_loader = TensorImageLoader(valid_data, batch_size, alpha)
+    test_loader = TensorImageLoader(test_data, batch_size, alpha)
 
-    valid_loader = torch.utils.data.DataLoader(
-        valid_data,
-        batch_size=batch_size, shuffle=True, **kwargs)
- 
-    test_loader = torch.utils.data.DataLoader(test_data,
-        batch_size=batch_size, shuffle=True, **kwargs)
-    
     return train_loader, valid_loader, test_loader
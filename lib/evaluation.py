@@ -0,0 +1,82 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def inference_mode():
+    # torch.inference_mode only exists from torch 1.9 on, no_grad is used on older versions.
+    return torch.inference_mode() if hasattr(torch, "inference_mode") else torch.no_grad()
+
+
+def compute_bpp(ll, x, alpha=1e-6):
+    """
+    Bits per dimension of the logit transformed images x [B, d] given their log-likelihood ll [B]. The correction
+    log2(sigmoid(x)) + log2(1 - sigmoid(x)) of the logit transform is computed as -(softplus(x) + softplus(-x)) / log(2).
+    """
+    d = x.shape[1]
+    return 8 - math.log2(1 - 2 * alpha) - (ll + (F.softplus(x) + F.softplus(-x)).sum(1)) / (d * math.log(2))
+
+
+def _batches(model, loader):
+    device = next(model.parameters()).device
+    for batch in loader:
+        x = batch[0] if isinstance(batch, (list, tuple)) else batch
+        yield x.view(x.shape[0], -1).float().to(device, non_blocking=True)
+
+
+def evaluate(model, loader, alpha=None, quantiles=(.05, .5, .95)):
+    """
+    Computes the log-likelihood under model, a normalizing flow possibly wrapped in nn.DataParallel, of the samples
+    given by loader, an iterable of tensors or of (x, target) pairs. The per-sample values stay on the device and are
+    transferred once at the end.
+    :param alpha: The parameter of the logit transform of image datasets, the bits per dimension are computed if given.
+    :return: A dict with the mean ("ll"), std ("ll_std") and quantiles ("ll_quantiles") of the per-sample
+    log-likelihood, the number of samples ("nb_samples") and the mean bits per dimension ("bpp") if alpha is given.
+    """
+    flow = model.module if isinstance(model, nn.DataParallel) else model
+    ll, bpp = [], []
+    with inference_mode():
+        for x in _batches(model, loader):
+            z, jac = model(x)
+            ll_batch = flow.z_log_density(z) + jac
+            ll.append(ll_batch)
+            if alpha is not None:
+                bpp.append(compute_bpp(ll_batch, x, alpha))
+        ll = torch.cat(ll)
+        sorted_ll = ll.sort()[0]
+        idx = [int(round(q * (ll.shape[0] - 1))) for q in quantiles]
+        stats = torch.cat([torch.stack([ll.mean(), ll.std()]), sorted_ll[idx]] +
+                          ([torch.cat(bpp).mean().view(1)] if alpha is not None else [])).cpu().tolist()
+    res = {"ll": stats[0], "ll_std": stats[1], "ll_quantiles": dict(zip(quantiles, stats[2:2 + len(quantiles)])),
+           "nb_samples": ll.shape[0]}
+    if alpha is not None:
+        res["bpp"] = stats[-1]
+    return res
+
+
+def threshold_sweep(model, loader, thresholds, alpha=None, max_rows=None):
+    """
+    Mean log-likelihood of the samples given by loader for each of the thresholds of the DAG conditioners, see
+    FCNormalizingFlow.threshold_sweep. Each forward is made of at most max_rows rows, by default the size of the
+    batch, such that the sweep fits in memory wherever evaluate does. A model wrapped in nn.DataParallel is run on its
+    first device.
+    :return: A dict with the lists of the mean log-likelihood ("ll") and bits per dimension ("bpp", if alpha is given)
+    for each threshold.
+    """
+    flow = model.module if isinstance(model, nn.DataParallel) else model
+    ll_sum, bpp_sum, nb_samples = 0., 0., 0
+    with inference_mode():
+        for x in _batches(model, loader):
+            ll = flow.threshold_sweep(x, thresholds, max_rows=x.shape[0] if max_rows is None else max_rows)
+            ll_sum = ll_sum + ll.sum(1)
+            if alpha is not None:
+                bpp_sum = bpp_sum + compute_bpp(ll.view(-1), x.repeat(len(thresholds), 1), alpha)\
+                    .view(len(thresholds), -1).sum(1)
+            nb_samples += x.shape[0]
+        stats = (torch.stack([ll_sum, bpp_sum]) if alpha is not None else ll_sum.view(1, -1)) / nb_samples
+        stats = stats.cpu().tolist()
+    res = {"ll": stats[0]}
+    if alpha is not None:
+        res["bpp"] = stats[1]
+    return res
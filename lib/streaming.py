@@ -0,0 +1,155 @@
+import queue
+import threading
+import numpy as np
+import torch
+
+
+class DeviceBatchStream(object):
+    """Iterates over the rows of a tensor by batches of contiguous views.
+
+    When shuffling, the whole tensor is gathered once per epoch into a buffer allocated once on its device, instead of
+    one gather per batch. The permutations are drawn from a generator seeded with seed, the permutation of the next
+    epoch being drawn in a background thread while the current one is iterated over. The views of an epoch are only
+    valid until the next epoch starts.
+    """
+
+    def __init__(self, X, batch_size, shuffle=True, drop_last=False, seed=None, prefetch=True):
+        self.X = X
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.prefetch = prefetch
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+        self.buffer = torch.empty_like(X) if shuffle else None
+        self._perm = None
+        self._thread = None
+
+    def __len__(self):
+        if self.drop_last:
+            return self.X.shape[0] // self.batch_size
+        return (self.X.shape[0] + self.batch_size - 1) // self.batch_size
+
+    def _draw_permutation(self):
+        perm = torch.randperm(self.X.shape[0], generator=self.generator)
+        self._perm = perm.pin_memory() if self.X.is_cuda else perm
+
+    def _next_permutation(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        else:
+            self._draw_permutation()
+        perm = self._perm
+        if self.prefetch:
+            self._thread = threading.Thread(target=self._draw_permutation)
+            self._thread.start()
+        return perm
+
+    def __iter__(self):
+        X = self.X
+        if self.shuffle:
+            perm = self._next_permutation().to(X.device, non_blocking=True)
+            X = torch.index_select(self.X, 0, perm, out=self.buffer)
+        end = len(self) * self.batch_size if self.drop_last else X.shape[0]
+        for i in range(0, end, self.batch_size):
+            yield X[i:i + self.batch_size]
+
+
+class ShardStream(object):
+    """Iterates over the rows of arrays which do not fit in memory, e.g. memory mapped .npy shards, by batches of
+    tensors on device, without concatenating them.
+
+    The shards are read by chunks of chunk_size contiguous rows. When shuffling, the chunks are read in a random order
+    and gathered into a shuffle buffer of about buffer_size rows which is shuffled before being cut into batches, the
+    rows left over by the last batch being carried to the next buffer. The buffers are filled by a background thread,
+    the next one being read while the current one is iterated over. Every row is seen once per epoch, such that only a
+    few buffers are held in memory at once.
+    """
+
+    def __init__(self, shards, batch_size, device="cpu", chunk_size=2**14, buffer_size=2**18, shuffle=True,
+                 drop_last=False, seed=None):
+        if not isinstance(shards, (list, tuple)):
+            shards = [shards]
+        self.shards = [np.load(s, mmap_mode='r') if isinstance(s, str) else s for s in shards]
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.chunk_size = chunk_size
+        self.buffer_size = max(buffer_size, batch_size)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.pin_memory = self.device.type == "cuda"
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+        self.N = sum(s.shape[0] for s in self.shards)
+        self.chunks = [(s, i) for s, shard in enumerate(self.shards) for i in range(0, shard.shape[0], chunk_size)]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.N // self.batch_size
+        return (self.N + self.batch_size - 1) // self.batch_size
+
+    def _fill(self, buffers, stop):
+        try:
+            if self.shuffle:
+                order = torch.randperm(len(self.chunks), generator=self.generator).tolist()
+            else:
+                order = range(len(self.chunks))
+            pending, nb_pending = [], 0
+            for k, c in enumerate(order):
+                s, i = self.chunks[c]
+                pending.append(self.shards[s][i:i + self.chunk_size])
+                nb_pending += pending[-1].shape[0]
+                last = k == len(order) - 1
+                if nb_pending < self.buffer_size and not last:
+                    continue
+                # Reads the chunks from the memory maps.
+                buf = torch.from_numpy(np.concatenate(pending).astype(np.float32, copy=False))
+                if self.shuffle:
+                    buf = buf[torch.randperm(buf.shape[0], generator=self.generator)]
+                n = buf.shape[0] if last else buf.shape[0] // self.batch_size * self.batch_size
+                pending, nb_pending = [buf[n:].numpy()], buf.shape[0] - n
+                buf = buf[:n].pin_memory() if self.pin_memory else buf[:n]
+                if not _put(buffers, buf, stop):
+                    return
+            _put(buffers, None, stop)
+        except Exception as e:
+            _put(buffers, e, stop)
+
+    def __iter__(self):
+        # One buffer ready in the queue while the next one is read.
+        buffers = queue.Queue(maxsize=1)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._fill, args=(buffers, stop))
+        thread.start()
+        try:
+            while True:
+                buf = buffers.get()
+                if buf is None:
+                    break
+                if isinstance(buf, Exception):
+                    raise buf
+                buf = buf.to(self.device, non_blocking=True)
+                end = buf.shape[0] // self.batch_size * self.batch_size if self.drop_last else buf.shape[0]
+                for i in range(0, end, self.batch_size):
+                    yield buf[i:i + self.batch_size]
+        finally:
+            stop.set()
+            thread.join()
+
+
+def _put(buffers, item, stop):
+    # Blocks until item is queued or the iteration is stopped.
+    while not stop.is_set():
+        try:
+            buffers.put(item, timeout=.1)
+            return True
+        except queue.Full:
+            pass
+    return False
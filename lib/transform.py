@@ -10,6 +10,24 @@ def logit_back(x, alpha=1E-6):
     y = torch.sigmoid(x)
     return (y - alpha)/(1.-2*alpha)
 
+def dequantize(x, alpha=1E-6):
+    """
+    Batched counterpart of AddUniformNoise for uint8 images x [B, ...]: returns logit((x + u) / 256, alpha) with
+    u ~ U[0, 1), computed in place on a single float tensor. The logit is skipped if alpha is None.
+    """
+    y = torch.rand(x.shape, device=x.device).add_(x)
+    if alpha is None:
+        return y.div_(256.)
+    y.mul_((1. - 2 * alpha) / 256.).add_(alpha)
+    return y.log() - torch.log1p(-y)
+
+def random_hflip(x, p=.5):
+    """
+    Flips each image of x [B, ..., W] along its width with probability p.
+    """
+    flip = torch.rand(x.shape[0], device=x.device) < p
+    return torch.where(flip.view((-1,) + (1,) * (x.dim() - 1)), x.flip(-1), x)
+
 class AddUniformNoise(object):
     def __init__(self, alpha=1E-6):
         self.alpha = alpha
@@ -21,3 +21,10 @@ class Conditioner(nn.Module):
     '''
     def depth(self):
         pass
+
+    '''
+    This returns the topological levels of the equivalent Bayesian Network as a list of index tensors, the variables
+    of a level only depending on the variables of the previous levels, or None if no such ordering is available.
+    '''
+    def levels(self):
+        return None
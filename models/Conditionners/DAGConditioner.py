@@ -1,7 +1,14 @@
 import torch
 import torch.nn as nn
 from .Conditioner import Conditioner
-import networkx as nx
+from .DAGness import power_trace, spectral_radius, hutchinson_trace
+from ..Precision import no_autocast
+
+
+def _inference_mode_enabled():
+    # Tensors created under torch.inference_mode (torch >= 1.9) cannot be modified in place nor saved for backward
+    # outside of it, the caches must not outlive the mode they were built in.
+    return hasattr(torch, "is_inference_mode_enabled") and torch.is_inference_mode_enabled()
 
 
 class DAGMLP(nn.Module):
@@ -19,6 +26,91 @@ class DAGMLP(nn.Module):
     def forward(self, x):
         return self.net(x)
 
+    '''
+    masked_forward(self, x, A, broadcast=False, idx=None):
+    :param x: A tensor [B, d]
+    :param A: A dense or sparse tensor [k, d], row i masks the inputs seen by the i-th embedding, or a dense tensor
+              [n, 1, k, d] of masks shared by B/n consecutive rows of x.
+    :param broadcast: With A [n, 1, k, d], applies each of the n masks to all the rows of x, x * W1 being computed
+                      once for the n masks.
+    :param idx: A tensor [k] of the variables embedded by the rows of A, all of them if None.
+    :return: the same [B*k, out_size] embeddings as forward on the masked inputs ([n*B*k, out_size] when broadcast),
+             the first layer being computed as A @ (x * W1) without building the [B*d, d] masked inputs. With a
+             sparse A its cost scales with the number of non zero entries of A. When the first layer takes 2d inputs
+             (hot encoding), the masked inputs of variable i are followed by its one-hot encoding, whose contribution
+             is the column d + i of W1.
+    '''
+    def masked_forward(self, x, A, broadcast=False, idx=None):
+        b_size, d = x.shape
+        first = self.net[0]
+        if first.in_features not in [d, 2 * d]:
+            # forward fails in the same way on the [B*k, d] masked inputs.
+            raise RuntimeError("The first layer of DAGMLP expects %d inputs, got %d masked inputs."
+                               % (first.in_features, d))
+        w = first.weight[:, :d].t()
+        if A.is_sparse:
+            xw = x.t().unsqueeze(2) * w.unsqueeze(1)
+            # torch.sparse.mm has no autocast rule, its inputs must have the same dtype.
+            with no_autocast(x.device):
+                h = torch.sparse.mm(A, xw.to(A.dtype).view(d, -1)).view(A.shape[0], b_size, -1).transpose(0, 1)
+        else:
+            xw = x.unsqueeze(2) * w.unsqueeze(0)
+            if A.dim() == 4:
+                xw = xw.view(1 if broadcast else A.shape[0], -1, d, xw.shape[-1])
+            h = A @ xw
+        if first.in_features == 2 * d:
+            w_hot = first.weight[:, d:].t()
+            h = h + (w_hot if idx is None else w_hot[idx])
+        h = h + first.bias
+        return self.net[1:](h.reshape(-1, h.shape[-1]))
+
+
+class DAGTopology:
+    """
+    Topological artifacts of the graph given by a boolean adjacency matrix [d, d] where adjacency[i, j] means that
+    variable i depends on variable j.
+    """
+    def __init__(self, adjacency):
+        adjacency = adjacency.float()
+        self.levels = self.topological_levels(adjacency)
+        self.is_dag = self.levels is not None
+        self.depth = len(self.levels) - 1 if self.is_dag else 0
+        self.order = torch.cat(self.levels) if self.is_dag else None
+        self.parents = list(adjacency.nonzero()[:, 1].split(adjacency.sum(1).long().tolist()))
+
+    @staticmethod
+    def topological_levels(adjacency):
+        # Kahn's algorithm where all the variables without remaining parents are removed at once.
+        remaining = torch.ones(adjacency.shape[0], dtype=torch.bool, device=adjacency.device)
+        nb_parents = adjacency.sum(1)
+        levels = []
+        while remaining.any():
+            ready = remaining & (nb_parents == 0)
+            if not ready.any():
+                return None
+            levels.append(ready.nonzero()[:, 0])
+            remaining &= ~ready
+            nb_parents -= adjacency[:, ready].sum(1)
+        return levels
+
+    @staticmethod
+    def is_acyclic(adjacency):
+        return DAGTopology.topological_levels(adjacency.float()) is not None
+
+    @staticmethod
+    def acyclic_threshold(weights, lower=.1):
+        # Removing edges cannot create a cycle, the smallest threshold (among lower and the edge weights) for which
+        # the graph {weights > threshold} is acyclic can thus be found by bisection.
+        candidates = torch.cat((torch.tensor([lower], device=weights.device), weights[weights > lower].unique()))
+        low, high = 0, candidates.shape[0] - 1
+        while low < high:
+            middle = (low + high) // 2
+            if DAGTopology.is_acyclic(weights > candidates[middle]):
+                high = middle
+            else:
+                low = middle + 1
+        return candidates[low].item()
+
 
 class DAGConditioner(Conditioner):
     def __init__(self, in_size, hidden, out_size, cond_in=0, soft_thresholding=True, h_thresh=0., gumble_T=1.,
@@ -28,6 +120,7 @@ class DAGConditioner(Conditioner):
             self.A = nn.Parameter(torch.ones(in_size, in_size) * 1.5 + torch.randn((in_size, in_size)) * .02)
         else:
             self.A = nn.Parameter(A_prior)
+        self._A_version = 0
         self.in_size = in_size
         self.exponent = self.in_size % 50
         self.s_thresh = soft_thresholding
@@ -41,7 +134,24 @@ class DAGConditioner(Conditioner):
             self.embedding_net = DAGMLP(in_net, hidden, out_size, cond_in)
         self.gumble = True
         self.hutchinson = False
+        # One of "exact", "hutchinson", "spectral" or "auto" (hutchinson for in_size >= stochastic_min_size). The
+        # spectral estimate is exactly 0 on acyclic graphs, checked with DAGTopology, and only approximate otherwise.
+        self.trace_estimator = "exact"
+        self.stochastic_min_size = 500
+        self.nb_probes = 16
+        self.hutchinson_tol = None
+        self.max_probes = 256
+        self.nb_power_iter = 10
+        self._u, self._v = None, None
+        self._trace, self._trace_key = None, None
         self.gumble_T = gumble_T
+        self.gate_share = 1
+        self.gate_buffer = False
+        self._gate_noise = None
+        # When not None, forward evaluates the batch once per threshold, see threshold_masks. If the T blocks of the
+        # batch are copies of the same rows, the first layer of a DAGMLP embedding is computed once for all of them.
+        self.sweep_thresholds = None
+        self.sweep_repeated_input = False
         self.hot_encoding = hot_encoding
         with torch.no_grad():
             self.constrainA(h_thresh)
@@ -62,11 +172,14 @@ class DAGConditioner(Conditioner):
         self.nb_epoch_update = nb_epoch_update
         self.no_update = 0
         self.is_invertible = False#torch.tensor(False)
+        self.sparse_forward = True
+        self.fused_forward = True
+        self._A_sparse = None
+        self._A_sparse_key = None
+        self._topology = None
+        self._topology_key = None
 
     def getAlpha(self):
-        with torch.no_grad():
-            _, S, _ = torch.svd(self.A**2, compute_uv=False)
-            alpha = 1/(torch.max(S) * self.in_size)
         alpha = torch.tensor(1./self.in_size)
         return alpha
 
@@ -75,13 +188,8 @@ class DAGConditioner(Conditioner):
 
     def post_process(self, zero_threshold=None):
         if zero_threshold is None:
-            zero_threshold = .1
-            G = nx.from_numpy_matrix((self.soft_thresholded_A().data.clone().abs() > zero_threshold).float().detach().cpu().numpy(), create_using=nx.DiGraph)
-            while not nx.is_directed_acyclic_graph(G):
-                zero_threshold += .05
-                G = nx.from_numpy_matrix(
-                    (self.soft_thresholded_A().data.clone().abs() > zero_threshold).float().detach().cpu().numpy(),
-                    create_using=nx.DiGraph)
+            weights = self.soft_thresholded_A().detach().abs() * (1. - torch.eye(self.in_size, device=self.A.device))
+            zero_threshold = DAGTopology.acyclic_threshold(weights, .1)
         self.stoch_gate = False
         self.noise_gate = False
         self.s_thresh = False
@@ -90,27 +198,44 @@ class DAGConditioner(Conditioner):
         self.A *= 1. - torch.eye(self.in_size, device=self.A.device)
         self.A.requires_grad = False
         self.A.grad = None
+        self._A_version += 1
 
-    def stochastic_gate(self, importance):
+    '''
+    stochastic_gate(self, importance, b_size):
+    :param importance: A tensor [d, d]
+    :param b_size: The batch size.
+    :return: gates [n, d, d] where n = b_size/gate_share, each sample being shared by gate_share consecutive rows of
+             the batch (n = b_size if gate_share does not divide it).
+    '''
+    def stochastic_gate(self, importance, b_size):
+        share = self.gate_share if b_size % self.gate_share == 0 else 1
+        shape = (b_size // share,) + importance.shape
         if self.gumble:
-            # Gumble soft-max gate
+            # Gumble soft-max gate, the difference of the two Gumbel noises follows a logistic distribution.
             temp = self.gumble_T
             epsilon = 1e-6
-            g1 = -torch.log(-torch.log(torch.rand(importance.shape, device=self.A.device)))
-            g2 = -torch.log(-torch.log(torch.rand(importance.shape, device=self.A.device)))
-            z1 = torch.exp((torch.log(importance + epsilon) + g1)/temp)
-            z2 = torch.exp((torch.log(1 - importance + epsilon) + g2)/temp)
-            return z1 / (z1 + z2)
+            u = self.gate_noise(shape)
+            logistic = torch.log(u) - torch.log(1. - u)
+            logits = torch.log(importance + epsilon) - torch.log(1 - importance + epsilon)
+            return torch.sigmoid((logits + logistic)/temp)
 
         else:
             beta_1, beta_2 = 3., 10.
             sigma = beta_1/(1. + beta_2*torch.sqrt((importance - .5)**2.))
             mu = importance
-            z = torch.randn(importance.shape, device=self.A.device) * sigma + mu + .25
+            z = torch.randn(shape, device=self.A.device) * sigma + mu + .25
             #non_importance = torch.sqrt((importance - 1.)**2)
             #z = z - non_importance/beta_1
             return torch.relu(z.clamp_max(1.))
 
+    def gate_noise(self, shape):
+        if not self.gate_buffer:
+            return torch.rand(shape, device=self.A.device)
+        if self._gate_noise is None or self._gate_noise.shape != shape or self._gate_noise.device != self.A.device \
+                or getattr(self._gate_noise, "is_inference", lambda: False)() != _inference_mode_enabled():
+            self._gate_noise = torch.empty(shape, device=self.A.device)
+        return self._gate_noise.uniform_()
+
     def noiser_gate(self, x, importance):
         noise = torch.randn(importance.shape, device=self.A.device) * torch.sqrt((1 - importance)**2)
         return importance*(x + noise)
@@ -119,73 +244,186 @@ class DAGConditioner(Conditioner):
         return 2*(torch.sigmoid(2*(self.A**2)) -.5)
 
     def hard_thresholded_A(self):
+        A = self.soft_thresholded_A() if self.s_thresh else self.A**2
+        return A * (A > self.h_thresh).float()
+
+    '''
+    threshold_masks(self, thresholds):
+    :param thresholds: A list of T values of h_thresh.
+    :return: the [T, 1, d, d] hard thresholded soft A for each threshold, the soft thresholding being shared.
+    '''
+    def threshold_masks(self, thresholds):
+        A = self.soft_thresholded_A()
+        return torch.stack([A * (A > t).float() for t in thresholds]).unsqueeze(1)
+
+    '''
+    Changes each time A is modified: by post_process, constrainA, an optimizer step or when loading a state dict, and
+    when entering or leaving inference mode.
+    '''
+    def A_version(self):
+        return self._A_version, self.A._version, self.A.data_ptr(), _inference_mode_enabled()
+
+    def sparse_A(self):
+        key = self.A_version()
+        if self._A_sparse is None or self._A_sparse_key != key:
+            self._A_sparse = self.A.detach().to_sparse()
+            self._A_sparse_key = key
+        return self._A_sparse
+
+    def effective_A(self):
+        if self.h_thresh > 0:
+            return self.hard_thresholded_A()
         if self.s_thresh:
-            return self.soft_thresholded_A()*(self.soft_thresholded_A() > self.h_thresh).float()
-        return self.A**2 * (self.A**2 > self.h_thresh).float()
+            return self.soft_thresholded_A()
+        return self.A
+
+    def is_deterministic(self):
+        return not ((self.h_thresh > 0 or self.s_thresh) and (self.stoch_gate or self.noise_gate))
+
+    def has_noise_gate(self):
+        return self.sweep_thresholds is None and (self.h_thresh > 0 or self.s_thresh) and not self.stoch_gate and self.noise_gate
+
+    '''
+    gated_A(self, b_size):
+    :return: the matrix masking the inputs of the embeddings, [d, d] for a deterministic conditioner and
+             [n, 1, d, d] with stochastic gates shared by b_size/n consecutive rows of the batch. During a threshold
+             sweep, the batch is made of T consecutive blocks masked by the T threshold masks.
+    '''
+    def gated_A(self, b_size):
+        if self.sweep_thresholds is not None:
+            return self.threshold_masks(self.sweep_thresholds)
+        if self.is_deterministic():
+            return self.effective_A()
+        return self.stochastic_gate(self.effective_A(), b_size).unsqueeze(1)
+
+    def is_sparse(self):
+        return self.sparse_forward and self.sweep_thresholds is None and not self.A.requires_grad and not self.s_thresh and self.h_thresh == 0 \
+               and isinstance(self.embedding_net, DAGMLP)
 
     def forward(self, x, context=None):
-        if self.h_thresh > 0:
-            if self.stoch_gate:
-                e = (x.unsqueeze(1).expand(-1, self.in_size, -1) * self.stochastic_gate(self.hard_thresholded_A().unsqueeze(0)
-                                                                                        .expand(x.shape[0], -1, -1)))\
-                    .view(x.shape[0] * self.in_size, -1)
-            elif self.noise_gate:
-                e = self.noiser_gate(x.unsqueeze(1).expand(-1, self.in_size, -1),
-                                     self.hard_thresholded_A().unsqueeze(0)
-                                     .expand(x.shape[0], -1, -1))\
-                    .view(x.shape[0] * self.in_size, -1)
-            else:
-                e = (x.unsqueeze(1).expand(-1, self.in_size, -1) * self.hard_thresholded_A().unsqueeze(0)
-                     .expand(x.shape[0], -1, -1)).view(x.shape[0] * self.in_size, -1)
-        elif self.s_thresh:
-            if self.stoch_gate:
-                e = (x.unsqueeze(1).expand(-1, self.in_size, -1) * self.stochastic_gate(self.soft_thresholded_A().unsqueeze(0)
-                                                                                        .expand(x.shape[0], -1, -1))).view(x.shape[0] * self.in_size, -1)
-            elif self.noise_gate:
-                e = self.noiser_gate(x.unsqueeze(1).expand(-1, self.in_size, -1),
-                                     self.soft_thresholded_A().unsqueeze(0).expand(x.shape[0], -1, -1))\
-                    .view(x.shape[0] * self.in_size, -1)
+        if self.is_sparse():
+            e = self.embedding_net.masked_forward(x, self.sparse_A())
+        elif self.fused_forward and not self.has_noise_gate() and isinstance(self.embedding_net, DAGMLP):
+            if self.sweep_thresholds is not None and self.sweep_repeated_input:
+                e = self.embedding_net.masked_forward(x[:x.shape[0] // len(self.sweep_thresholds)],
+                                                      self.gated_A(x.shape[0]), broadcast=True)
             else:
-                e = (x.unsqueeze(1).expand(-1, self.in_size, -1) * self.soft_thresholded_A().unsqueeze(0)
-                     .expand(x.shape[0], -1, -1)).view(x.shape[0] * self.in_size, -1)
+                e = self.embedding_net.masked_forward(x, self.gated_A(x.shape[0]))
         else:
-            e = (x.unsqueeze(1).expand(-1, self.in_size, -1) * self.A.unsqueeze(0).expand(x.shape[0], -1, -1))\
-                .view(x.shape[0] * self.in_size, -1)
+            e = self.embedding_net(self.hot_encoded_input(self.masked_input(x)))
 
         if self.hot_encoding:
             hot_encoding = torch.eye(self.in_size, device=self.A.device).unsqueeze(0).expand(x.shape[0], -1, -1)\
                 .contiguous().view(-1, self.in_size)
-            e = self.embedding_net(e)
             full_e = torch.cat((e, hot_encoding), 1).view(x.shape[0], self.in_size, -1)
             # TODO Add context
             return full_e
 
-        return self.embedding_net(e).view(x.shape[0], self.in_size, -1)#.permute(0, 2, 1).contiguous().view(x.shape[0], -1)
+        return e.view(x.shape[0], self.in_size, -1)#.permute(0, 2, 1).contiguous().view(x.shape[0], -1)
+
+    '''
+    partial_forward(self, x, idx, context=None):
+    :param x: A tensor [B, d]
+    :param idx: A tensor [k] of variable indices.
+    :return: conditioning factors [B, k, h] of the variables idx, the same as forward(x)[:, idx] for a deterministic
+             conditioner.
+    '''
+    def partial_forward(self, x, idx, context=None):
+        A = self.effective_A()[idx]
+        if isinstance(self.embedding_net, DAGMLP):
+            e = self.embedding_net.masked_forward(x, A, idx=idx)
+        else:
+            e = self.embedding_net((x.unsqueeze(1) * A.unsqueeze(0)).view(-1, self.in_size))
+
+        if self.hot_encoding:
+            hot_encoding = torch.eye(self.in_size, device=self.A.device)[idx].unsqueeze(0).expand(x.shape[0], -1, -1)\
+                .contiguous().view(-1, self.in_size)
+            return torch.cat((e, hot_encoding), 1).view(x.shape[0], idx.shape[0], -1)
+
+        return e.view(x.shape[0], idx.shape[0], -1)
+
+    def topology(self):
+        key = (self.A_version(), self.h_thresh, self.s_thresh)
+        if self._topology_key != key:
+            with torch.no_grad():
+                self._topology = DAGTopology(self.effective_A() != 0)
+            self._topology_key = key
+        return self._topology
+
+    def levels(self):
+        if not self.is_deterministic():
+            return None
+        return self.topology().levels
+
+    '''
+    hot_encoded_input(self, masked):
+    :param masked: The masked inputs [B*d, d] of the embeddings.
+    :return: masked, followed by the one-hot encoding of the embedded variable when the embedding is a DAGMLP built
+             with hot_encoding, whose first layer takes 2d inputs.
+    '''
+    def hot_encoded_input(self, masked):
+        if not isinstance(self.embedding_net, DAGMLP) or self.embedding_net.net[0].in_features != 2 * self.in_size:
+            return masked
+        hot_encoding = torch.eye(self.in_size, device=masked.device, dtype=masked.dtype)\
+            .repeat(masked.shape[0] // self.in_size, 1)
+        return torch.cat((masked, hot_encoding), 1)
+
+    def masked_input(self, x):
+        if self.has_noise_gate():
+            return self.noiser_gate(x.unsqueeze(1).expand(-1, self.in_size, -1),
+                                    self.effective_A().unsqueeze(0).expand(x.shape[0], -1, -1))\
+                .view(x.shape[0] * self.in_size, -1)
+        A = self.gated_A(x.shape[0])
+        if A.dim() == 4:
+            return (x.view(A.shape[0], -1, 1, self.in_size) * A).view(x.shape[0] * self.in_size, -1)
+        return (x.unsqueeze(1) * A.unsqueeze(0)).view(x.shape[0] * self.in_size, -1)
 
     def constrainA(self, zero_threshold=.0001):
         self.A *= (self.A.clone().abs() > zero_threshold).float()
         self.A *= 1. - torch.eye(self.in_size, device=self.A.device)
+        self._A_version += 1
         return
 
+    def get_trace_estimator(self):
+        if self.hutchinson != 0:
+            return "hutchinson"
+        if self.trace_estimator == "auto":
+            return "hutchinson" if self.in_size >= self.stochastic_min_size else "exact"
+        return self.trace_estimator
+
     def get_power_trace(self):
         alpha = min(1., self.alpha)
         alpha *= self.alpha_factor
-        if self.hutchinson != 0:
-            h_iter = self.hutchinson
-            trace = 0.
-            I = torch.eye(self.in_size, device=self.A.device)
-            for j in range(h_iter):
-                e0 = torch.randn(self.in_size, 1).to(self.A.device)
-                e = e0
-                for i in range(self.in_size):
-                    e = (I + alpha * self.A ** 2) @ e
-
-                trace += (e0 * e).sum()
-            return trace / h_iter - self.in_size
+        estimator = self.get_trace_estimator()
+        # Without gradients the value only depends on A and on the parameters of the estimator.
+        key = (self.A_version(), float(alpha), self.exponent, estimator, self.hutchinson, self.nb_probes,
+               self.hutchinson_tol, self.max_probes, self.nb_power_iter)
+        if not torch.is_grad_enabled():
+            if self._trace_key == key:
+                return self._trace
+            self._trace, self._trace_key = self._power_trace(alpha, estimator), key
+            return self._trace
+        return self._power_trace(alpha, estimator)
+
+    def _power_trace(self, alpha, estimator):
+        if estimator == "spectral":
+            M = alpha * self.A ** 2
+            # The power iterations only reach 0 on a nilpotent M after more iterations than the depth of the graph, the
+            # exact check keeps the estimate at 0 on acyclic graphs such that post-processing can trigger.
+            if DAGTopology.is_acyclic(M.detach() != 0):
+                return (M * 0.).sum()
+            if self._u is None:
+                self._u = torch.ones(self.in_size, 1)
+                self._v = torch.ones(self.in_size, 1)
+            rho, self._u, self._v = spectral_radius(M, self._u.to(self.A.device), self._v.to(self.A.device),
+                                                    self.nb_power_iter)
+            return rho
 
         B = (torch.eye(self.in_size, device=self.A.device) + alpha * self.A ** 2)
-        M = torch.matrix_power(B, self.exponent)
-        return torch.diag(M).sum() - self.in_size
+        if estimator == "hutchinson":
+            nb_probes = self.hutchinson if self.hutchinson != 0 else self.nb_probes
+            return hutchinson_trace(B, self.exponent, nb_probes, self.hutchinson_tol, self.max_probes) - self.in_size
+        return power_trace(B, self.exponent) - self.in_size
 
     def update_dual_param(self):
         with torch.no_grad():
@@ -215,6 +453,7 @@ class DAGConditioner(Conditioner):
                     self.s_thresh = True
                     self.h_thresh = 0.
                     self.A = nn.Parameter(A_before)
+                    self._A_version += 1
                     self.A.requires_grad = True
                     self.A.grad = self.A.clone()
                     self.alpha = torch.tensor(self.getAlpha())
@@ -231,9 +470,7 @@ class DAGConditioner(Conditioner):
                           (int(self.A.sum().item()), ((self.d - 1)*self.d)/2), flush=True)
 
             else:
-                G = nx.from_numpy_matrix(self.A.detach().cpu().numpy() ** 2, create_using=nx.DiGraph)
-                try:
-                    nx.find_cycle(G)
+                if not self.topology().is_dag:
                     print("Bad news there is still cycles in this graph.", flush=True)
                     self.A.requires_grad = True
                     self.A.grad = self.A.clone()
@@ -245,7 +482,7 @@ class DAGConditioner(Conditioner):
                     self.prev_trace = self.get_power_trace()
                     self.dag_const = torch.tensor(1.)
                     print(self.in_size, self.prev_trace)
-                except nx.NetworkXNoCycle:
+                else:
                     print("Good news there is no cycle in this graph.", flush=True)
                     print("Depth of the graph is: %d" % self.depth())
                     self.is_invertible = True#torch.tensor(True)
@@ -254,10 +491,7 @@ class DAGConditioner(Conditioner):
         return lag_const
 
     def depth(self):
-        G = nx.from_numpy_matrix((self.A.detach() > 0).float().cpu().numpy(), create_using=nx.DiGraph)
-        if self.is_invertible or nx.is_directed_acyclic_graph(G):
-            return int(nx.dag_longest_path_length(G))
-        return 0
+        return self.topology().depth
 
     def loss(self):
         lag_const = self.get_power_trace()
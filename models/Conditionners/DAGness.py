@@ -0,0 +1,70 @@
+import torch
+
+
+class PowerTrace(torch.autograd.Function):
+    """
+    Computes tr(M^n) with M^(n-1) obtained by repeated squaring. Only M^(n-1) is kept for the backward pass, whose
+    gradient n * (M^(n-1))^T is known in closed form, instead of the log(n) intermediate products autograd would save.
+    """
+    @staticmethod
+    def forward(ctx, M, exponent):
+        ctx.exponent = exponent
+        if exponent == 0:
+            ctx.save_for_backward(None)
+            return M.new_tensor(float(M.shape[0]))
+        P = torch.matrix_power(M, exponent - 1)
+        ctx.save_for_backward(P)
+        return (P * M.t()).sum()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        P, = ctx.saved_tensors
+        if P is None:
+            return None, None
+        return grad_output * ctx.exponent * P.t(), None
+
+
+def power_trace(M, exponent):
+    return PowerTrace.apply(M, exponent)
+
+
+def spectral_radius(M, u, v, nb_iter=10, eps=1e-30):
+    """
+    Estimates the spectral radius of the non negative matrix M by power iterations warm started from the right and
+    left eigenvectors estimates u and v [d, 1]. Returns the estimate, differentiable w.r.t. M, and the updated vectors.
+    On a nilpotent M (an acyclic graph) the estimate is only 0 if nb_iter exceeds the depth of the graph.
+    """
+    with torch.no_grad():
+        # A small positive component keeps the iterations alive when the previous M was nilpotent.
+        u = u + 1e-3 / M.shape[0]
+        v = v + 1e-3 / M.shape[0]
+        for i in range(nb_iter):
+            u = M @ u
+            u = u / u.norm().clamp_min(eps)
+            v = M.t() @ v
+            v = v / v.norm().clamp_min(eps)
+    rho = (v.t() @ M @ u).sum() / (v.t() @ u).sum().clamp_min(eps)
+    return rho, u, v
+
+
+def hutchinson_trace(M, exponent, nb_probes=16, rel_tol=None, max_probes=256):
+    """
+    Estimates tr(M^n) with Rademacher probes drawn on the device of M, nb_probes at a time as one [d, nb_probes]
+    block. When rel_tol is given, blocks are added until the standard error of the estimate falls below rel_tol times
+    its absolute value or max_probes probes have been used.
+    """
+    estimates = []
+    while True:
+        V = torch.randint(0, 2, (M.shape[0], nb_probes), device=M.device).to(M.dtype) * 2. - 1.
+        MV = V
+        for i in range(exponent):
+            MV = M @ MV
+        estimates.append((V * MV).sum(0))
+        if rel_tol is None or len(estimates) * nb_probes >= max_probes:
+            break
+        with torch.no_grad():
+            all_estimates = torch.cat(estimates)
+            std_error = all_estimates.std() / all_estimates.shape[0] ** .5
+            if std_error <= rel_tol * all_estimates.mean().abs():
+                break
+    return torch.cat(estimates).mean()
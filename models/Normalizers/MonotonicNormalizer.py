@@ -1,6 +1,8 @@
 import torch
-from UMNN import NeuralIntegral, ParallelNeuralIntegral
+from UMNN import ParallelNeuralIntegral
 from .Normalizer import Normalizer
+from ..Precision import autocast
+from .Quadrature import FusedNeuralIntegral, AdaptiveNeuralIntegral, stacked_neural_integral
 import torch.nn as nn
 
 
@@ -29,13 +31,15 @@ class IntegrandNet(nn.Module):
         layers.pop()
         layers.append(ELUPlus())
         self.net = nn.Sequential(*layers)
+        self.autocast_dtype = None
 
     def forward(self, x, h):
         nb_batch, in_d = x.shape
         x = torch.cat((x, h), 1)
         x_he = x.view(nb_batch, -1, in_d).transpose(1, 2).contiguous().view(nb_batch * in_d, -1)
-        y = self.net(x_he).view(nb_batch, -1)
-        return y
+        with autocast(x.device, self.autocast_dtype):
+            y = self.net(x_he)
+        return y.to(x.dtype).view(nb_batch, -1)
 
 
 class MonotonicNormalizer(Normalizer):
@@ -47,17 +51,40 @@ class MonotonicNormalizer(Normalizer):
             self.integrand_net = integrand_net
         self.solver = solver
         self.nb_steps = nb_steps
+        self.inverse_tol = 1e-6
+        # Parameters of the "CCAdaptive" solver, which ignores nb_steps.
+        self.min_nb_steps = 4
+        self.max_nb_steps = 64
+        self.integration_tol = 1e-4
+        self.max_rows = 2**18
+        self.inverse_max_iter = 50
+        # Without gradients, the "CC" solver evaluates the integrand on all the nodes at once, in chunks of at most
+        # max_rows (cpu_max_rows on CPU, where smaller chunks keep the activations in cache) rows.
+        self.stacked_nodes = True
+        self.cpu_max_rows = 2**12
 
     def forward(self, x, h, context=None):
-        x0 = torch.zeros(x.shape).to(x.device)
         xT = x
         z0 = h[:, :, 0]
+        if self.solver == "CCAdaptive":
+            # Each (sample, variable) pair is integrated as its own row.
+            z, jac = AdaptiveNeuralIntegral.apply(xT.reshape(-1, 1), h.reshape(-1, h.shape[2]), self.integrand_net,
+                                                  self.min_nb_steps, self.max_nb_steps, self.integration_tol,
+                                                  self.max_rows, *self.integrand_net.parameters())
+            return z.view(x.shape) + z0, jac.view(x.shape)
         h = h.permute(0, 2, 1).contiguous().view(x.shape[0], -1)
 
-        if self.solver == "CC":
-            z = NeuralIntegral.apply(x0, xT, self.integrand_net, _flatten(self.integrand_net.parameters()),
-                                     h, self.nb_steps) + z0
+        if self.solver == "CC" and self.stacked_nodes and not torch.is_grad_enabled():
+            max_rows = self.cpu_max_rows if xT.device.type == "cpu" else self.max_rows
+            z, jac = stacked_neural_integral(xT, h, self.integrand_net, self.nb_steps, max_rows)
+            return z + z0, jac
+        elif self.solver == "CC":
+            # The integrand at the first node of the quadrature is the diagonal of the Jacobian.
+            z, jac = FusedNeuralIntegral.apply(xT, h, self.integrand_net, self.nb_steps,
+                                               *self.integrand_net.parameters())
+            return z + z0, jac
         elif self.solver == "CCParallel":
+            x0 = torch.zeros(x.shape).to(x.device)
             z = ParallelNeuralIntegral.apply(x0, xT, self.integrand_net,
                                              _flatten(self.integrand_net.parameters()),
                                              h, self.nb_steps) + z0
@@ -67,17 +94,31 @@ class MonotonicNormalizer(Normalizer):
 
 
     def inverse_transform(self, z, h, context=None):
-        x_max = torch.ones_like(z) * 20
-        x_min = -torch.ones_like(z) * 20
-        z_max, _ = self.forward(x_max, h, context)
-        z_min, _ = self.forward(x_min, h, context)
-        for i in range(20):
-            x_middle = (x_max + x_min) / 2
-            z_middle, _ = self.forward(x_middle, h, context)
-            left = (z_middle > z).float()
-            right = 1 - left
-            x_max = left * x_middle + right * x_max
-            x_min = right * x_middle + left * x_min
-            z_max = left * z_middle + right * z_max
-            z_min = right * z_middle + left * z_min
-        return (x_max + x_min) / 2
+        # Safeguarded Newton: the integrand is the derivative of the transformation, steps leaving the bracket
+        # [x_min, x_max] are replaced by bisection. Each (sample, variable) pair is solved independently and removed
+        # from the computations once converged.
+        with torch.no_grad():
+            shape = z.shape
+            z = z.reshape(-1, 1)
+            h = h.reshape(-1, 1, h.shape[-1])
+            x = torch.zeros_like(z)
+            x_max = torch.ones_like(z) * 20
+            x_min = -torch.ones_like(z) * 20
+            active = torch.arange(z.shape[0], device=z.device)
+            for i in range(self.inverse_max_iter):
+                x_a, x_min_a, x_max_a = x[active], x_min[active], x_max[active]
+                z_a, jac_a = self.forward(x_a, h[active], context)
+                diff = z_a - z[active]
+                above = diff > 0
+                x_max_a = torch.where(above, x_a, x_max_a)
+                x_min_a = torch.where(above, x_min_a, x_a)
+                x_new = x_a - diff / jac_a
+                outside = (x_new <= x_min_a) | (x_new >= x_max_a)
+                x_new = torch.where(outside, (x_min_a + x_max_a) / 2, x_new)
+                converged = (diff.abs() < self.inverse_tol) | (x_max_a - x_min_a < self.inverse_tol)
+                x[active] = torch.where(converged, x_a, x_new)
+                x_min[active], x_max[active] = x_min_a, x_max_a
+                active = active[~converged[:, 0]]
+                if active.shape[0] == 0:
+                    break
+            return x.view(shape)
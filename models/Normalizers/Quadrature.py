@@ -0,0 +1,181 @@
+import torch
+import numpy as np
+import math
+from functools import lru_cache
+
+
+def compute_cc_weights(nb_steps):
+    lam = np.arange(0, nb_steps + 1, 1).reshape(-1, 1)
+    lam = np.cos((lam @ lam.T) * math.pi / nb_steps)
+    lam[:, 0] = .5
+    lam[:, -1] = .5 * lam[:, -1]
+    lam = lam * 2 / nb_steps
+    W = np.arange(0, nb_steps + 1, 1).reshape(-1, 1)
+    W[np.arange(1, nb_steps + 1, 2)] = 0
+    W = 2 / (1 - W ** 2)
+    W[0] = 1
+    W[np.arange(1, nb_steps + 1, 2)] = 0
+    cc_weights = torch.tensor(lam.T @ W).float()
+    steps = torch.tensor(np.cos(np.arange(0, nb_steps + 1, 1).reshape(-1, 1) * math.pi / nb_steps)).float()
+
+    return cc_weights, steps
+
+
+@lru_cache(maxsize=64)
+def _cached_cc_weights(nb_steps, dtype, device):
+    # Built as normal tensors even under torch.inference_mode (torch >= 1.9) to remain usable by autograd afterwards.
+    with torch.inference_mode(False) if hasattr(torch, "inference_mode") else torch.no_grad():
+        cc_weights, steps = compute_cc_weights(nb_steps)
+        return cc_weights.to(device=device, dtype=dtype), steps.to(device=device, dtype=dtype)
+
+
+def cc_weights_like(nb_steps, x):
+    """
+    Returns the Clenshaw-Curtis weights and nodes for nb_steps with the dtype and on the device of x. They are built
+    once per (nb_steps, dtype, device) and shared by all the normalizers, such that randomizing nb_steps between
+    batches does not recompute them nor copy them to the device again.
+    """
+    return _cached_cc_weights(nb_steps, x.dtype, x.device)
+
+
+def integrand_vjp(integrand, params, x, h, nb_steps, cc_weights, steps, grad_z, grad_jac):
+    # Vector-Jacobian products of (z, jac) w.r.t. the parameters of the integrand, h and x. The integral is
+    # differentiated w.r.t. x with the Leibniz rule, jac being the value of the integrand at the first node (x).
+    g_params = [torch.zeros_like(p) for p in params]
+    g_h = torch.zeros_like(h)
+    g_x = None
+    with torch.enable_grad():
+        h = h.detach().requires_grad_()
+        for i in range(nb_steps + 1):
+            x_i = (x * (steps[i] + 1) / 2).detach()
+            last_node = grad_jac is not None and i == 0
+            if last_node:
+                x_i.requires_grad_()
+            f = integrand(x_i, h)
+            v = cc_weights[i] * x / 2 * grad_z
+            if last_node:
+                g_x, = torch.autograd.grad(f, x_i, grad_jac, retain_graph=True)
+                v = v + grad_jac
+            grads = torch.autograd.grad(f, params + [h], v, allow_unused=True)
+            for j, g in enumerate(grads[:-1]):
+                if g is not None:
+                    g_params[j] += g
+            g_h += grads[-1]
+    return g_params, g_h, g_x
+
+
+class FusedNeuralIntegral(torch.autograd.Function):
+    """
+    Computes z = int_0^x integrand(t, h) dt with a Clenshaw-Curtis quadrature together with jac = integrand(x, h), the
+    first node of the quadrature grid, such that the integrand is evaluated once per node. The parameters of the
+    integrand are given as extra arguments so that their gradients are returned without being flattened.
+    """
+    @staticmethod
+    def forward(ctx, x, h, integrand, nb_steps, *params):
+        cc_weights, steps = cc_weights_like(nb_steps, x)
+        with torch.no_grad():
+            z = 0.
+            for i in range(nb_steps + 1):
+                f = integrand(x * (steps[i] + 1) / 2, h)
+                if i == 0:
+                    jac = f
+                z = z + cc_weights[i] * f
+            z = z * x / 2
+        ctx.integrand = integrand
+        ctx.nb_steps = nb_steps
+        ctx.save_for_backward(x, h, jac)
+        return z, jac
+
+    @staticmethod
+    def backward(ctx, grad_z, grad_jac):
+        x, h, jac = ctx.saved_tensors
+        integrand, nb_steps = ctx.integrand, ctx.nb_steps
+        cc_weights, steps = cc_weights_like(nb_steps, x)
+        params = list(integrand.parameters())
+        g_params, g_h, g_x = integrand_vjp(integrand, params, x, h, nb_steps, cc_weights, steps, grad_z, grad_jac)
+        x_grad = grad_z * jac if g_x is None else grad_z * jac + g_x
+        return (x_grad, g_h, None, None) + tuple(g_params)
+
+
+def evaluate_nodes(integrand, x, h, nodes, max_rows=None):
+    """
+    Evaluates the integrand at x * (node + 1) / 2 for each of the nodes [k, 1] and returns a tensor [k, *x.shape]. The
+    nodes are stacked along the batch axis such that each call to the integrand sees at most max_rows entries of x,
+    which are the rows given to the network of an IntegrandNet.
+    """
+    b_size, row_size = x.shape
+    max_rows = x.numel() * nodes.shape[0] if max_rows is None else max_rows
+    rows = max(1, min(b_size, max_rows // row_size))
+    nb_nodes = max(1, max_rows // (rows * row_size))
+    f = []
+    for i in range(0, nodes.shape[0], nb_nodes):
+        s = nodes[i:i + nb_nodes].view(-1, 1, 1)
+        f_s = []
+        for j in range(0, b_size, rows):
+            x_s = (x[j:j + rows].unsqueeze(0) * (s + 1) / 2).view(-1, row_size)
+            h_s = h[j:j + rows].unsqueeze(0).expand(s.shape[0], -1, -1).reshape(-1, h.shape[1])
+            f_s.append(integrand(x_s, h_s).view(s.shape[0], -1, row_size))
+        f.append(torch.cat(f_s, 1))
+    return torch.cat(f, 0)
+
+
+def stacked_neural_integral(x, h, integrand, nb_steps, max_rows=None):
+    """
+    Forward only counterpart of FusedNeuralIntegral which evaluates the integrand on all the nodes with a few large
+    calls, see evaluate_nodes.
+    """
+    cc_weights, steps = cc_weights_like(nb_steps, x)
+    f = evaluate_nodes(integrand, x, h, steps, max_rows)
+    return (cc_weights.unsqueeze(2) * f).sum(0) * x / 2, f[0]
+
+
+class AdaptiveNeuralIntegral(torch.autograd.Function):
+    """
+    Clenshaw-Curtis quadrature of int_0^x integrand(t, h) dt with a number of nodes chosen for each element. x is
+    [N, 1] and h [N, c], one row per (sample, variable) pair. The grids with n and 2n steps being nested, each
+    refinement only evaluates the n new nodes for the elements whose error estimate |Q_2n - Q_n| is above tol,
+    starting from min_nb_steps and up to max_nb_steps. Returns z and jac = integrand(x, h) as FusedNeuralIntegral.
+    """
+    @staticmethod
+    def forward(ctx, x, h, integrand, min_nb_steps, max_nb_steps, tol, max_rows, *params):
+        with torch.no_grad():
+            n = min_nb_steps
+            cc_weights, steps = cc_weights_like(n, x)
+            f = evaluate_nodes(integrand, x, h, steps, max_rows)
+            jac = f[0]
+            q = (cc_weights.unsqueeze(2) * f).sum(0) * x / 2
+            z = q.clone()
+            nb_steps = torch.full((x.shape[0],), n, dtype=torch.long, device=x.device)
+            idx = torch.arange(x.shape[0], device=x.device)
+            while idx.shape[0] > 0 and 2 * n <= max_nb_steps:
+                n *= 2
+                cc_weights, steps = cc_weights_like(n, x)
+                x_a = x[idx]
+                f_new = evaluate_nodes(integrand, x_a, h[idx], steps[1::2], max_rows)
+                f_fine = torch.empty((n + 1,) + x_a.shape, dtype=x.dtype, device=x.device)
+                f_fine[0::2], f_fine[1::2] = f, f_new
+                q_fine = (cc_weights.unsqueeze(2) * f_fine).sum(0) * x_a / 2
+                z[idx] = q_fine
+                nb_steps[idx] = n
+                refine = ((q_fine - q).abs() > tol)[:, 0]
+                idx, f, q = idx[refine], f_fine[:, refine], q_fine[refine]
+        ctx.integrand = integrand
+        ctx.save_for_backward(x, h, jac, nb_steps)
+        return z, jac
+
+    @staticmethod
+    def backward(ctx, grad_z, grad_jac):
+        x, h, jac, nb_steps = ctx.saved_tensors
+        integrand = ctx.integrand
+        params = list(integrand.parameters())
+        g_params = [torch.zeros_like(p) for p in params]
+        g_h = torch.zeros_like(h)
+        g_x = torch.zeros_like(x)
+        for n in nb_steps.unique().tolist():
+            idx = (nb_steps == n).nonzero()[:, 0]
+            cc_weights, steps = cc_weights_like(n, x)
+            g_params_n, g_h[idx], g_x[idx] = integrand_vjp(integrand, params, x[idx], h[idx], n, cc_weights, steps,
+                                                           grad_z[idx], grad_jac[idx])
+            for j, g in enumerate(g_params_n):
+                g_params[j] += g
+        return (grad_z * jac + g_x, g_h, None, None, None, None, None) + tuple(g_params)
@@ -1,7 +1,10 @@
 import torch
 import torch.nn as nn
+import inspect
+from torch.utils.checkpoint import checkpoint
 from .Conditionners import Conditioner, DAGConditioner
 from .Normalizers import Normalizer
+from .Precision import autocast, check_precision
 
 
 class NormalizingFlow(nn.Module):
@@ -57,15 +60,88 @@ class NormalizingFlow(nn.Module):
     def invert(self, z, context=None):
         pass
 
+    '''
+    Runs the conditioners and the integrand networks of the forward pass under autocast to dtype (e.g.
+    torch.bfloat16), or in full precision if dtype is None. The log-Jacobian, the base density and the DAGness are
+    still computed in float32. Raises a RuntimeError if torch.autocast is not available for a reduced dtype.
+    '''
+    def set_precision(self, dtype):
+        check_precision(dtype)
+        for module in self.modules():
+            if hasattr(module, "autocast_dtype"):
+                module.autocast_dtype = dtype
+
+    '''
+    Limits the memory used by the forward of each step to about budget bytes by processing the batch in micro
+    batches, or removes the limit if budget is None.
+    '''
+    def set_memory_budget(self, budget):
+        for module in self.modules():
+            if isinstance(module, NormalizingFlowStep):
+                module.memory_budget = budget
+
+
+def _checkpoint(function, *args):
+    if "use_reentrant" in inspect.signature(checkpoint).parameters:
+        return checkpoint(function, *args, use_reentrant=False)
+    # The reentrant checkpoint only computes the gradients of the parameters if one of its inputs requires grad.
+    return checkpoint(function, *args, torch.empty(0, requires_grad=True))
+
 
 class NormalizingFlowStep(NormalizingFlow):
     def __init__(self, conditioner: Conditioner, normalizer: Normalizer):
         super(NormalizingFlowStep, self).__init__()
         self.conditioner = conditioner
         self.normalizer = normalizer
+        self.autocast_dtype = None
+        self.memory_budget = None
+
+    '''
+    sample_size(self, x):
+    :return: a rough number of bytes of activations per sample: each variable goes through the masked inputs and the
+             layers of the conditioner and of the normalizer.
+    '''
+    def sample_size(self, x):
+        widths = sum(m.out_features for m in self.modules() if isinstance(m, nn.Linear)) + x.shape[1]
+        return x.shape[1] * widths * x.element_size()
 
+    '''
+    When a memory budget is set, the batch is processed by micro batches, checkpointed when gradients are required
+    such that only the activations of one micro batch are alive at a time. The outputs are the same as without micro
+    batches, except for the draws of the stochastic gates. During a threshold sweep, the batch is made of T blocks
+    masked by different thresholds and each micro batch takes the same rows of every block.
+    '''
     def forward(self, x, context=None):
-        h = self.conditioner(x, context)
+        if self.memory_budget is None:
+            return self._forward(x, context)
+        nb_blocks = self.nb_sweep_blocks()
+        rows = x.shape[0] // nb_blocks
+        b_size = max(1, int(self.memory_budget // self.sample_size(x)) // nb_blocks)
+        if b_size >= rows:
+            return self._forward(x, context)
+        x_b = x.view(nb_blocks, rows, *x.shape[1:])
+        context_b = context.view(nb_blocks, rows, *context.shape[1:]) if context is not None else None
+        z, jac = [], []
+        for i in range(0, rows, b_size):
+            x_i = x_b[:, i:i + b_size].flatten(0, 1)
+            context_i = context_b[:, i:i + b_size].flatten(0, 1) if context is not None else None
+            if torch.is_grad_enabled():
+                z_i, jac_i = _checkpoint(lambda x, context, *args: self._forward(x, context), x_i, context_i)
+            else:
+                z_i, jac_i = self._forward(x_i, context_i)
+            z.append(z_i.view(nb_blocks, -1, *z_i.shape[1:]))
+            jac.append(jac_i.view(nb_blocks, -1))
+        return torch.cat(z, 1).flatten(0, 1), torch.cat(jac, 1).flatten(0, 1)
+
+    def nb_sweep_blocks(self):
+        if type(self.conditioner) is DAGConditioner and self.conditioner.sweep_thresholds is not None:
+            return len(self.conditioner.sweep_thresholds)
+        return 1
+
+    def _forward(self, x, context=None):
+        with autocast(x.device, self.autocast_dtype):
+            h = self.conditioner(x, context)
+        h = h.to(x.dtype)
         z, jac = self.normalizer(x, h, context)
         return z, torch.log(jac).sum(1)
 
@@ -97,12 +173,19 @@ class NormalizingFlowStep(NormalizingFlow):
 
     def invert(self, z, context=None):
         x = torch.zeros_like(z)
+        levels = self.conditioner.levels()
+        if levels is not None:
+            # Each level only depends on the previous ones which are already inverted.
+            for idx in levels:
+                h = self.conditioner.partial_forward(x, idx, context)
+                x = x.index_copy(1, idx, self.normalizer.inverse_transform(z[:, idx], h, context))
+            return x
+
         for i in range(self.conditioner.depth() + 1):
-            print(i, "/", self.conditioner.depth() + 1)
             h = self.conditioner(x, context)
             x_prev = x
             x = self.normalizer.inverse_transform(z, h, context)
-            if torch.norm(x - x_prev) == 0.:
+            if torch.equal(x, x_prev):
                 break
         return x
 
@@ -168,6 +251,43 @@ class FCNormalizingFlow(NormalizingFlow):
             z = self.steps[-step].invert(z, context)
         return z
 
+    '''
+    threshold_sweep(self, x, thresholds, context=None, max_rows=None):
+    :param x: A tensor [B, d]
+    :param thresholds: A list of T values of h_thresh for the DAG conditioners, which are evaluated with soft
+                       thresholding and without gates.
+    :param max_rows: The maximum number of rows of each forward, x is split in chunks of max_rows/T rows which are
+                     repeated T times. All of x is repeated at once if None.
+    :return: the log-likelihood [T, B] of x for each threshold. The thresholds share the soft thresholding of A and
+             the first layer of the DAGMLP embeddings of the first step, which are computed once per chunk.
+    '''
+    def threshold_sweep(self, x, thresholds, context=None, max_rows=None):
+        T = len(thresholds)
+        conditioners = [c for c in self.getConditioners() if type(c) is DAGConditioner]
+        # Only the first step of the whole flow, possibly nested in inner flows, sees the repeated inputs.
+        first_step = self.steps[0]
+        while not isinstance(first_step, NormalizingFlowStep):
+            first_step = first_step.steps[0]
+        first = [c for c in first_step.getConditioners() if type(c) is DAGConditioner]
+        for conditioner in conditioners:
+            conditioner.sweep_thresholds = thresholds
+        # The inputs of the first step are the same for every threshold.
+        for conditioner in first:
+            conditioner.sweep_repeated_input = True
+        chunk = x.shape[0] if max_rows is None else max(1, max_rows // T)
+        ll = []
+        try:
+            for i in range(0, x.shape[0], chunk):
+                x_i = x[i:i + chunk].repeat(T, 1)
+                context_i = context[i:i + chunk].repeat(T, *[1] * (context.dim() - 1)) if context is not None else None
+                z, jac = self(x_i, context_i)
+                ll.append((self.z_log_density(z) + jac).view(T, -1))
+        finally:
+            for conditioner in conditioners:
+                conditioner.sweep_thresholds = None
+                conditioner.sweep_repeated_input = False
+        return torch.cat(ll, 1)
+
 
 class CNNormalizingFlow(FCNormalizingFlow):
     def __init__(self, steps, z_log_density, dropping_factors):
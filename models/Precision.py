@@ -0,0 +1,30 @@
+import contextlib
+import torch
+
+
+'''
+autocast(device, dtype):
+:return: a context running the eligible operations (linear layers, matmuls) in dtype on the device type of device,
+         or doing nothing if dtype is None. Reduced precisions require torch.autocast (torch >= 1.10), see
+         check_precision.
+'''
+def autocast(device, dtype):
+    if dtype is None or dtype == torch.float32 or not hasattr(torch, "autocast"):
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+'''
+no_autocast(device):
+:return: a context disabling autocast on the device type of device, for the operations without an autocast rule.
+'''
+def no_autocast(device):
+    if not hasattr(torch, "autocast"):
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, enabled=False)
+
+
+def check_precision(dtype):
+    if dtype is not None and dtype != torch.float32 and not hasattr(torch, "autocast"):
+        raise RuntimeError("Autocast to %s requires torch >= 1.10 (torch.autocast), found torch %s."
+                           % (dtype, torch.__version__))